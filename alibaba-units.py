@@ -1,22 +1,40 @@
 import argparse
 import json
 import subprocess
+import time
+from functools import partial
+
+from units_common import (
+    AuditResult, CellHistory, CommandRunner, add_run_args, exact_workloads, prune_regions, pruned_regions_line,
+    run_cells, store_from_args
+)
 
-# Usage python3 ./alibaba-units.py --profiles <profile_1> <profile_2> <profile_3> <profile_4>
 
-parser = argparse.ArgumentParser(prog="SentinelOne CNS Alibaba Unit Audit")
-parser.add_argument("--profiles", help="Alibaba profile(s) separated by space", nargs='+', default=[], required=False)
-parser.add_argument("--regions", help="Regions to run script for", nargs='+', default=[], required=False)
-args = parser.parse_args()
 
-PROFILES = args.profiles
-REGIONS = args.regions
+# Usage python3 ./alibaba-units.py --profiles <profile_1> <profile_2> <profile_3> <profile_4>
 
-def alibaba_ecs_get_all_regions(profileFlag):
-    output = subprocess.check_output(
-        f"aliyun ecs DescribeRegions {profileFlag}",
-        text=True, shell=True
-    )
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS Alibaba Unit Audit")
+    parser.add_argument("--profiles", help="Alibaba profile(s) separated by space", nargs='+', default=[], required=False)
+    parser.add_argument("--regions", help="Regions to run script for", nargs='+', default=[], required=False)
+    add_run_args(parser, shard=False)
+    parser.add_argument("--prune-regions", help="Skip regions without any resource in the Resource Center index", action="store_true", required=False)
+    return parser.parse_args(argv)
+
+def alibaba_ecs_get_all_regions(profileFlag, runner, regions=()):
+    # without its regions nothing of the profile can be counted, it must not look like an empty profile
+    try:
+        output = runner.check_output(
+            f"aliyun ecs DescribeRegions {profileFlag}",
+            api="ecs DescribeRegions"
+        )
+    except subprocess.CalledProcessError as e:
+        print("[Error] [Command]", e.cmd)
+        print("[Error] [Command-Output]", e.output)
+        raise Exception(f"could not get the alibaba regions with {profileFlag or 'the default profile'}")
+    except subprocess.TimeoutExpired as e:
+        print("[Error] [Command]", e.cmd)
+        raise Exception(f"timed out getting the alibaba regions with {profileFlag or 'the default profile'}")
     regions_info = json.loads(output)
 
     all_regions_active = []
@@ -24,73 +42,172 @@ def alibaba_ecs_get_all_regions(profileFlag):
     if regions_info and 'Regions' in regions_info and 'Region' in regions_info['Regions']:
         all_regions_active = [region['RegionId'] for region in regions_info['Regions']['Region']]
 
-    if len(REGIONS) == 0:
+    if len(regions) == 0:
         return all_regions_active
 
     # if only some regions to be whitelisted
-    print('[Info] Found whitelisted regions', REGIONS)
+    print('[Info] Found whitelisted regions', regions)
     regions_to_run = []
     for region in all_regions_active:
-        if region in REGIONS:
+        if region in regions:
             regions_to_run.append(region)
     print("[Info] Valid whitelisted regions", regions_to_run)
     return regions_to_run
 
+def alibaba_regions_with_resources(profileFlag, runner):
+    # one Resource Center call for the whole account, None when it can not be used (eg. Resource Center not enabled)
+    try:
+        output = runner.check_output(
+            f"aliyun resourcecenter GetResourceCounts --GroupByKey RegionId {profileFlag}",
+            api="resourcecenter GetResourceCounts", stderr=subprocess.STDOUT
+        )
+        j = json.loads(output)
+    except subprocess.CalledProcessError as e:
+        print('[Error] Error getting resources per region, not pruning regions')
+        print("[Error] [Command]", e.cmd)
+        print("[Error] [Command-Output]", e.output)
+        return None
+    except subprocess.TimeoutExpired as e:
+        print('[Error] Timed out getting resources per region, not pruning regions')
+        print("[Error] [Command]", e.cmd)
+        return None
+    except json.decoder.JSONDecodeError as e:
+        print("[Error] parsing resources per region, not pruning regions\n", e)
+        return None
+
+    return {group['GroupName'] for group in j.get('ResourceCounts', []) if group.get('Count', 0) > 0}
+
 class SentinelOneCNSAlibabaUnitAudit:
-    def __init__(self, profile):
+    def __init__(self, profile, regions=(), workers=1, runner=None, history=None, store=None,
+                 prune_regions_with_resources=False, write_csv=True):
+        self.profile = profile
         self.file_path = "alibaba-{profile}-units.csv".format(profile=profile) if profile else 'alibaba-units.csv'
         self.profile_flag = "--profile {profile}".format(profile=profile) if profile else ''
+        self.workers = workers
+        self.runner = runner or CommandRunner()
+        self.history = history
+        self.store = store
+        self.write_csv = write_csv
         self.total_resource_count = 0
         self.total_workload_count = 0
+        self.lines = []
+        self.result = AuditResult("alibaba", profile)
         
-        self.regions = alibaba_ecs_get_all_regions(self.profile_flag)
-
-        with open(self.file_path, 'w') as f:
-            f.write("Resource Type, Unit Counted, Workloads, Error Regions\n")
+        self.regions = alibaba_ecs_get_all_regions(self.profile_flag, self.runner, regions)
+        self.pruned_regions = None
+        if prune_regions_with_resources:
+            self.regions, self.pruned_regions = prune_regions(
+                self.regions, alibaba_regions_with_resources(self.profile_flag, self.runner), "resources"
+            )
+        self.result.pruned_regions = self.pruned_regions
+
+        if self.write_csv:
+            with open(self.file_path, 'w') as f:
+                f.write("Resource Type, Unit Counted, Workloads, Error Regions\n")
 
     def add_result(self, k, v, w, e=''):
-        with open(self.file_path, 'a') as f:
-            f.write('{k}, {v}, {w}, {e}\n'.format(k=k,v=v,w=w,e=e))
+        self.lines.append('{k}, {v}, {w}, {e}\n'.format(k=k,v=v,w=w,e=e))
+
+    def write_results(self):
+        if self.write_csv:
+            with open(self.file_path, 'a') as f:
+                f.writelines(self.lines)
+        if self.store:
+            if self.pruned_regions is not None:
+                self.store.add_pruned_regions("alibaba", self.profile, self.pruned_regions)
+            self.store.commit()
 
     def count_all(self):
-        self.count("Alibaba ECS Instance", self.count_ecs_instances, workload_multiplier=1)
+        started = time.monotonic()
+        self.count_services([
+            ("Alibaba ECS Instance", self.count_ecs_instances, 1),
+        ])
 
         self.add_result('TOTAL', self.total_resource_count, round(self.total_workload_count))
-        print("results stored at", self.file_path)
-
-    def count(self, svcName, svcCb, workload_multiplier):
-        count = 0
-        error = ''
-        for region in self.regions:
-            try:
-                count += svcCb(region)
-            except subprocess.CalledProcessError as e:
-                print('[Error] Error getting ', svcName, region)
-                print("[Error] [Command]", e.cmd)
-                print("[Error] [Command-Output]", e.output)
-                error += f"{region}, "
-            except json.decoder.JSONDecodeError as e:
-                print("[Error] parsing data from Cloud Provider\n", e)
-                error += f"{region} (Json Error), "
-
-            print(f'[info] Fetched {svcName} - {region}')
+        if self.pruned_regions is not None:
+            self.lines.append(pruned_regions_line(self.pruned_regions))
+        self.write_results()
+        if self.write_csv:
+            print("results stored at", self.file_path)
+        self.result.seconds = time.monotonic() - started
+        return self.result
+
+    def count_services(self, services):
+        cells = []
+        for svcName, svcCb, _ in services:
+            for region in self.regions:
+                key = CellHistory.key("alibaba", self.profile, svcName, region)
+                cells.append((key, partial(self.count_region, svcName, svcCb, region)))
+        results = iter(run_cells(cells, self.workers, self.history, self.runner))
+
+        for svcName, _, workload_multiplier in services:
+            count = 0
+            error = ''
+            for region in self.regions:
+                (region_count, region_error), seconds = next(results)
+                self.result.cells.append((svcName, region, region_count, region_error, seconds))
+                if self.store:
+                    self.store.add("alibaba", self.profile, region, svcName, region_count, workload_multiplier, region_error)
+                count += region_count
+                error += region_error
+            self.result.services.append((svcName, count, workload_multiplier, error))
+            self.count(svcName, count, error, workload_multiplier)
+
+    def count_region(self, svcName, svcCb, region):
+        try:
+            count = svcCb(region)
+            error = ''
+        except subprocess.CalledProcessError as e:
+            print('[Error] Error getting ', svcName, region)
+            print("[Error] [Command]", e.cmd)
+            print("[Error] [Command-Output]", e.output)
+            count = 0
+            error = f"{region}, "
+        except subprocess.TimeoutExpired as e:
+            print('[Error] Timed out getting ', svcName, region)
+            print("[Error] [Command]", e.cmd)
+            count = 0
+            error = f"{region} (Timeout), "
+        except json.decoder.JSONDecodeError as e:
+            print("[Error] parsing data from Cloud Provider\n", e)
+            count = 0
+            error = f"{region} (Json Error), "
+
+        print(f'[info] Fetched {svcName} - {region}')
+        return count, error
+
+    def count(self, svcName, count, error, workload_multiplier):
         if count or error != '':
-            workloads = count * workload_multiplier
+            workloads = exact_workloads(count, workload_multiplier)
             self.total_resource_count += count
             self.total_workload_count += workloads
             self.add_result(svcName, count, workloads, error)
 
     def count_ecs_instances(self, region):
-        output = subprocess.check_output(
+        output = self.runner.check_output(
           f"aliyun ecs DescribeInstances --RegionId {region} {self.profile_flag}",
-          text=True, shell=True
+          api="ecs DescribeInstances"
         )
         j = json.loads(output)
         if j is None:
             return 0
         return len(j)
 
-if __name__ == '__main__':
-    profiles = PROFILES if len(PROFILES) > 0 else [None]
+def main(argv=None):
+    args = parse_args(argv)
+    runner = CommandRunner(args.call_timeout, args.cell_timeout, args.hedge_factor)
+    history = CellHistory(args.history_file)
+    store = store_from_args(args)
+
+    profiles = args.profiles if len(args.profiles) > 0 else [None]
     for p in profiles:
-        SentinelOneCNSAlibabaUnitAudit(p).count_all()
+        try:
+            SentinelOneCNSAlibabaUnitAudit(
+                p, regions=args.regions, workers=args.workers, runner=runner, history=history, store=store,
+                prune_regions_with_resources=args.prune_regions
+            ).count_all()
+        except Exception as e:
+            print("[Error]", e)
+
+if __name__ == '__main__':
+    main()
@@ -1,60 +1,124 @@
 import argparse
+import datetime
 import json
 import subprocess
+import time
+from functools import partial
+
+from units_common import (
+    AuditResult, CellHistory, CommandRunner, add_run_args, exact_workloads, in_shard, prune_regions,
+    pruned_regions_line, run_cells, store_from_args, write_shard
+)
 
-# Usage python3 ./aws-units.py --profiles <profile_1> <profile_2> <profile_3> <profile_4>
 
-parser = argparse.ArgumentParser(prog="SentinelOne CNS AWS Unit Audit")
-parser.add_argument("--profiles", help="AWS profile(s) separated by space", nargs='+', default=[], required=False)
-parser.add_argument("--regions", help="Regions to run script for", nargs='+', default=[], required=False)
-args = parser.parse_args()
 
-PROFILES = args.profiles
-REGIONS = args.regions
+# Usage python3 ./aws-units.py --profiles <profile_1> <profile_2> <profile_3> <profile_4>
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS AWS Unit Audit")
+    parser.add_argument("--profiles", help="AWS profile(s) separated by space", nargs='+', default=[], required=False)
+    parser.add_argument("--regions", help="Regions to run script for", nargs='+', default=[], required=False)
+    add_run_args(parser)
+    parser.add_argument("--prune-regions", help="Skip regions without any usage in Cost Explorer over the last --prune-days days", action="store_true", required=False)
+    parser.add_argument("--prune-days", help="Days of Cost Explorer usage looked at by --prune-regions", type=int, default=30, required=False)
+    return parser.parse_args(argv)
 
 
-def aws_describe_regions(profile):
+def aws_describe_regions(profile, runner, regions=()):
     profile_flag = "--profile {profile}".format(profile=profile) if profile else ''
     try:
-        output = subprocess.check_output(
+        output = runner.check_output(
             "aws {profile_flag} ec2 describe-regions --filters \"Name=opt-in-status,Values=opted-in,opt-in-not-required\" --output json".format(
                 profile_flag=profile_flag),
-            universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+            api="ec2 describe-regions", stderr=subprocess.STDOUT
         )
+    # without its regions nothing of the account can be counted, it must not look like an empty account
     except subprocess.CalledProcessError as e:
-        print('[Error] Error getting regions')
         print("[Error] [Command]", e.cmd)
         print("[Error] [Command-Output]", e.output)
-        return []
+        raise Exception(f"could not get the regions of aws profile {profile or 'default'}")
+    except subprocess.TimeoutExpired as e:
+        print("[Error] [Command]", e.cmd)
+        raise Exception(f"timed out getting the regions of aws profile {profile or 'default'}")
 
     if "The config profile ({profile}) could not be found".format(profile=profile) in output:
         raise Exception("found invalid aws profile {profile}".format(profile=profile))
     j = json.loads(output)
     all_regions_active = [region_object['RegionName'] for region_object in j['Regions']]
-    if len(REGIONS) == 0:
+    if len(regions) == 0:
         return all_regions_active
 
     # if only some regions to be whitelisted
-    print('found whitelisted regions', REGIONS)
+    print('found whitelisted regions', regions)
     regions_to_run = []
     for region in all_regions_active:
-        if region in REGIONS:
+        if region in regions:
             regions_to_run.append(region)
     print("valid whitelisted regions", regions_to_run)
     return regions_to_run
 
 
+def aws_regions_with_usage(profile_flag, runner, days=30):
+    # one Cost Explorer call for the whole account, None when it can not be used (eg. missing ce:GetCostAndUsage)
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days=days)
+    try:
+        output = runner.check_output(
+            f"aws {profile_flag} --region us-east-1 --output json ce get-cost-and-usage "
+            f"--time-period Start={start.isoformat()},End={end.isoformat()} --granularity MONTHLY "
+            f"--metrics UsageQuantity --group-by Type=DIMENSION,Key=REGION",
+            api="ce get-cost-and-usage", stderr=subprocess.STDOUT
+        )
+        j = json.loads(output)
+    except subprocess.CalledProcessError as e:
+        print('[Error] Error getting usage per region, not pruning regions')
+        print("[Error] [Command]", e.cmd)
+        print("[Error] [Command-Output]", e.output)
+        return None
+    except subprocess.TimeoutExpired as e:
+        print('[Error] Timed out getting usage per region, not pruning regions')
+        print("[Error] [Command]", e.cmd)
+        return None
+    except json.decoder.JSONDecodeError as e:
+        print("[Error] parsing usage per region, not pruning regions\n", e)
+        return None
+
+    used_regions = set()
+    for result in j.get("ResultsByTime", []):
+        for group in result.get("Groups", []):
+            if float(group["Metrics"]["UsageQuantity"]["Amount"]) > 0:
+                used_regions.add(group["Keys"][0])
+    return used_regions
+
+
 class SentinelOneCNSAWSUnitAudit:
-    def __init__(self, profile):
+    def __init__(self, profile, regions=(), workers=1, runner=None, history=None, store=None, shard=None,
+                 prune_regions_with_usage=False, prune_days=30, write_csv=True):
+        self.profile = profile
         self.file_path = "aws-{profile}-units.csv".format(profile=profile) if profile else 'aws-units.csv'
         self.profile_flag = "--profile {profile}".format(profile=profile) if profile else ''
+        self.workers = workers
+        self.runner = runner or CommandRunner()
+        self.history = history
+        self.store = store
+        self.shard = shard
+        self.write_csv = write_csv
         self.total_resource_count = 0
         self.total_workload_count = 0
-        self.regions = aws_describe_regions(profile)
+        self.lines = []
+        self.shard_services = []
+        self.shard_results = {}
+        self.result = AuditResult("aws", profile)
+        self.regions = aws_describe_regions(profile, self.runner, regions)
+        self.pruned_regions = None
+        if prune_regions_with_usage:
+            self.regions, self.pruned_regions = prune_regions(self.regions, aws_regions_with_usage(self.profile_flag, self.runner, prune_days))
+        self.result.pruned_regions = self.pruned_regions
 
-        with open(self.file_path, 'w') as f:
-            # Write Header
-            f.write("Resource Type, Unit Counted, Workloads, Error Regions\n")
+        if self.write_csv and not self.shard:
+            with open(self.file_path, 'w') as f:
+                # Write Header
+                f.write("Resource Type, Unit Counted, Workloads, Error Regions\n")
 
     def build_aws_cli_command(self, service, api, paginate=True, region=None, query=None, additional_args=None):
         region_flag = paginate_flag = query_flag = additional_flag = ""
@@ -73,38 +137,92 @@ class SentinelOneCNSAWSUnitAudit:
         return cmd
 
     def add_result(self, k, v, w, e=""):
-        with open(self.file_path, 'a') as f:
-            f.write('{k}, {v}, {w}, {e}\n'.format(k=k, v=v, w=w, e=e))
+        self.lines.append('{k}, {v}, {w}, {e}\n'.format(k=k, v=v, w=w, e=e))
 
-    def count_all(self):
-        self.count("AWS EC2 Instance", self.count_ec2_instances, workload_multiplier=1)
-        self.count("AWS Container Repository", self.count_ecr_repositories, workload_multiplier=0.1)
-        self.count("AWS Kubernetes Cluster (EKS)", self.count_eks_clusters, workload_multiplier=1)
-        self.count("AWS ECS Cluster", self.count_ecs_clusters, workload_multiplier=1)
-        self.count("AWS Lambda Function", self.count_lambda_functions, workload_multiplier=0.02)
-        self.count("Amazon ECS Tasks (on Fargate)", self.count_ecs_tasks_on_fargate, workload_multiplier=0.1)
+    def write_results(self):
+        if self.shard:
+            self.file_path = write_shard("aws", self.profile, self.shard, self.shard_services, self.regions, self.shard_results, self.pruned_regions)
+        elif self.write_csv:
+            with open(self.file_path, 'a') as f:
+                f.writelines(self.lines)
+        if self.store:
+            if self.pruned_regions is not None:
+                self.store.add_pruned_regions("aws", self.profile, self.pruned_regions)
+            self.store.commit()
 
+    def count_all(self):
+        started = time.monotonic()
+        self.count_services([
+            ("AWS EC2 Instance", self.count_ec2_instances, 1),
+            ("AWS Container Repository", self.count_ecr_repositories, 0.1),
+            ("AWS Kubernetes Cluster (EKS)", self.count_eks_clusters, 1),
+            ("AWS ECS Cluster", self.count_ecs_clusters, 1),
+            ("AWS Lambda Function", self.count_lambda_functions, 0.02),
+            ("Amazon ECS Tasks (on Fargate)", self.count_ecs_tasks_on_fargate, 0.1),
+        ])
 
         self.add_result('TOTAL', self.total_resource_count, round(self.total_workload_count))
-        print("[Info] Results stored at", self.file_path)
-
-    def count(self, svcName, svcCb, workload_multiplier):
-        count = 0
-        error = ''
-        for region in self.regions:
-            try:
-                count += svcCb(region)
-            except subprocess.CalledProcessError as e:
-                print('[Error] Error getting ', svcName, region)
-                print("[Error] [Command]", e.cmd)
-                print("[Error] [Command-Output]", e.output)
-                error += f"{region}, "
-            except json.decoder.JSONDecodeError as e:
-                print("[Error] parsing data from Cloud Provider\n \n", e)
-                error += f"{region} (JSON), "
-            print(f'[info] Fetched {svcName} - {region}')
+        if self.pruned_regions is not None:
+            self.lines.append(pruned_regions_line(self.pruned_regions))
+        self.write_results()
+        if self.write_csv or self.shard:
+            print("[Info] Results stored at", self.file_path)
+        self.result.seconds = time.monotonic() - started
+        return self.result
+
+    def count_services(self, services):
+        cells = []
+        for svcName, svcCb, _ in services:
+            for region in self.regions:
+                key = CellHistory.key("aws", self.profile, svcName, region)
+                if in_shard(key, self.shard):
+                    cells.append((key, partial(self.count_region, svcName, svcCb, region)))
+        results = dict(zip([key for key, _ in cells], run_cells(cells, self.workers, self.history, self.runner)))
+
+        # rows and error regions are put together in the sequential order, whatever order the cells ran in
+        for svcName, _, workload_multiplier in services:
+            self.shard_services.append((svcName, workload_multiplier))
+            count = 0
+            error = ''
+            for region in self.regions:
+                key = CellHistory.key("aws", self.profile, svcName, region)
+                if key not in results:
+                    continue
+                (region_count, region_error), seconds = results[key]
+                self.shard_results[(svcName, region)] = (region_count, region_error)
+                self.result.cells.append((svcName, region, region_count, region_error, seconds))
+                if self.store:
+                    self.store.add("aws", self.profile, region, svcName, region_count, workload_multiplier, region_error)
+                count += region_count
+                error += region_error
+            self.result.services.append((svcName, count, workload_multiplier, error))
+            self.count(svcName, count, error, workload_multiplier)
+
+    def count_region(self, svcName, svcCb, region):
+        try:
+            count = svcCb(region)
+            error = ''
+        except subprocess.CalledProcessError as e:
+            print('[Error] Error getting ', svcName, region)
+            print("[Error] [Command]", e.cmd)
+            print("[Error] [Command-Output]", e.output)
+            count = 0
+            error = f"{region}, "
+        except subprocess.TimeoutExpired as e:
+            print('[Error] Timed out getting ', svcName, region)
+            print("[Error] [Command]", e.cmd)
+            count = 0
+            error = f"{region} (Timeout), "
+        except json.decoder.JSONDecodeError as e:
+            print("[Error] parsing data from Cloud Provider\n \n", e)
+            count = 0
+            error = f"{region} (JSON), "
+        print(f'[info] Fetched {svcName} - {region}')
+        return count, error
+
+    def count(self, svcName, count, error, workload_multiplier):
         if count or error != '':
-            workloads = count * workload_multiplier
+            workloads = exact_workloads(count, workload_multiplier)
             
             self.total_resource_count += count
             self.total_workload_count += workloads
@@ -112,7 +230,7 @@ class SentinelOneCNSAWSUnitAudit:
             self.add_result(svcName, count, workloads, error)
 
     def count_ec2_instances(self, region):
-        output = subprocess.check_output(
+        output = self.runner.check_output(
             # "aws --region {region} {profile_flag} --query \"Reservations[].Instances\" ec2 describe-instances --output json --no-paginate".format(region=region, profile_flag=self.profile_flag),
             self.build_aws_cli_command(
                 service="ec2",
@@ -120,7 +238,7 @@ class SentinelOneCNSAWSUnitAudit:
                 paginate=False,
                 query="\"Reservations[].Instances\"",
                 region=region),
-            universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+            api="ec2 describe-instances", stderr=subprocess.STDOUT
         )
         j = json.loads(output)
         if j is None or len(j) == 0:
@@ -128,7 +246,7 @@ class SentinelOneCNSAWSUnitAudit:
         return len(j)
 
     def count_ecr_repositories(self, region):
-        output = subprocess.check_output(
+        output = self.runner.check_output(
             # "aws --region {region} {profile_flag} ecr describe-repositories --query \"repositories[].repositoryArn\" --output json --no-paginate".format(region=region,profile_flag=self.profile_flag)
             self.build_aws_cli_command(
                 service="ecr",
@@ -136,7 +254,7 @@ class SentinelOneCNSAWSUnitAudit:
                 query="\"repositories[].repositoryArn\"",
                 paginate=False,
                 region=region),
-            universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+            api="ecr describe-repositories", stderr=subprocess.STDOUT
         )
         j = json.loads(output)
         if j is None or len(j) == 0:
@@ -144,14 +262,14 @@ class SentinelOneCNSAWSUnitAudit:
         return len(j)
 
     def count_eks_clusters(self, region):
-        output = subprocess.check_output(
+        output = self.runner.check_output(
             # f"aws --region {region} {self.profile_flag} eks list-clusters --output json --no-paginate",
             self.build_aws_cli_command(
                 service="eks",
                 api="list-clusters",
                 paginate=False,
                 region=region),
-            universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+            api="eks list-clusters", stderr=subprocess.STDOUT
         )
         j = json.loads(output)
         c = len(j.get("clusters", []))
@@ -160,7 +278,7 @@ class SentinelOneCNSAWSUnitAudit:
         return c
 
     def count_lambda_functions(self, region):
-        output = subprocess.check_output(
+        output = self.runner.check_output(
             # f"aws --region {region} {self.profile_flag} lambda list-functions --query 'Functions[*].FunctionName' --output json --no-paginate",
             self.build_aws_cli_command(
                 service="lambda",
@@ -168,7 +286,7 @@ class SentinelOneCNSAWSUnitAudit:
                 paginate=False,
                 query="\"Functions[*].FunctionName\"",
                 region=region),
-            universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+            api="lambda list-functions", stderr=subprocess.STDOUT
         )
         j = json.loads(output)
         if j is None or len(j) == 0:
@@ -176,7 +294,7 @@ class SentinelOneCNSAWSUnitAudit:
         return len(j)
 
     def count_ecs_clusters(self, region):
-        output = subprocess.check_output(
+        output = self.runner.check_output(
             # f"aws --region {region} {self.profile_flag} ecs list-clusters --query 'clusterArns' --output json --no-paginate",
             self.build_aws_cli_command(
                 service="ecs",
@@ -184,7 +302,7 @@ class SentinelOneCNSAWSUnitAudit:
                 paginate=False,
                 query="\"clusterArns\"",
                 region=region),
-            universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+            api="ecs list-clusters", stderr=subprocess.STDOUT
         )
         j = json.loads(output)
         if j is None or len(j) == 0:
@@ -192,7 +310,7 @@ class SentinelOneCNSAWSUnitAudit:
         return len(j)
     
     def count_ecs_tasks_on_fargate(self, region):
-        output = subprocess.check_output(
+        output = self.runner.check_output(
             # f"aws --region {region} {self.profile_flag} ecs list-clusters --query 'clusterArns' --output json --no-paginate",
             self.build_aws_cli_command(
                 service="ecs",
@@ -200,7 +318,7 @@ class SentinelOneCNSAWSUnitAudit:
                 paginate=False,
                 query="\"clusterArns\"",
                 region=region),
-            universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+            api="ecs list-clusters", stderr=subprocess.STDOUT
         )
         cluster_arns = json.loads(output)
         
@@ -210,7 +328,7 @@ class SentinelOneCNSAWSUnitAudit:
             return count_fargate_tasks
         
         for cluster_arn in cluster_arns:
-            output = subprocess.check_output(
+            output = self.runner.check_output(
                 # f"aws --region {region} {self.profile_flag} ecs list-tasks --query 'taskArns' --output json --no-paginate --cluster {cluster_arn}",
                 self.build_aws_cli_command(
                     service="ecs",
@@ -219,14 +337,14 @@ class SentinelOneCNSAWSUnitAudit:
                     query="\"taskArns\"",
                     additional_args=f"--cluster {cluster_arn}",
                     region=region),
-                universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+                api="ecs list-tasks", stderr=subprocess.STDOUT
             )
             tasks_arns = json.loads(output)
             
             if len(tasks_arns) == 0:
                 continue
             
-            output = subprocess.check_output(
+            output = self.runner.check_output(
                 # f"aws --region {region} {self.profile_flag} ecs describe-tasks --query 'tasks' --output json --no-paginate --cluster {cluster_arn} --tasks task_arn1 task_arn2 ...",
                 self.build_aws_cli_command(
                     service="ecs",
@@ -235,7 +353,7 @@ class SentinelOneCNSAWSUnitAudit:
                     query="\"tasks\"",
                     additional_args=f'--cluster {cluster_arn} --tasks {" ".join(tasks_arns)}',
                     region=region),
-                universal_newlines=True, shell=True, stderr=subprocess.STDOUT
+                api="ecs describe-tasks", stderr=subprocess.STDOUT
             )
             
             tasks = json.loads(output)
@@ -247,7 +365,22 @@ class SentinelOneCNSAWSUnitAudit:
         return count_fargate_tasks
 
 
-if __name__ == '__main__':
-    profiles = PROFILES if len(PROFILES) > 0 else [None]
+def main(argv=None):
+    args = parse_args(argv)
+    runner = CommandRunner(args.call_timeout, args.cell_timeout, args.hedge_factor)
+    history = CellHistory(args.history_file)
+    store = store_from_args(args)
+
+    profiles = args.profiles if len(args.profiles) > 0 else [None]
     for p in profiles:
-        SentinelOneCNSAWSUnitAudit(p).count_all()
+        try:
+            SentinelOneCNSAWSUnitAudit(
+                p, regions=args.regions, workers=args.workers, runner=runner, history=history, store=store, shard=args.shard,
+                prune_regions_with_usage=args.prune_regions, prune_days=args.prune_days
+            ).count_all()
+        except Exception as e:
+            print("[Error]", e)
+
+
+if __name__ == '__main__':
+    main()
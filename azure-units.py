@@ -1,24 +1,36 @@
 import argparse
 import json
 import subprocess
+import time
+from functools import partial
+
+from units_common import (
+    AuditResult, CellHistory, CommandRunner, add_run_args, exact_workloads, in_shard, run_cells, store_from_args,
+    write_shard
+)
 
-# Usage python3 ./azure-units.py --subscriptions <subscription_1> <subscription_2> <subscription_3> <subscription_4>
 
-parser = argparse.ArgumentParser(prog="SentinelOne CNS Azure Unit Audit")
-parser.add_argument("--subscriptions", help="Azure subscription(s) separated by space", nargs='+', default=[], required=True)
-args = parser.parse_args()
 
-SUBSCRIPTIONS = args.subscriptions
+# Usage python3 ./azure-units.py --subscriptions <subscription_1> <subscription_2> <subscription_3> <subscription_4>
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS Azure Unit Audit")
+    parser.add_argument("--subscriptions", help="Azure subscription(s) separated by space", nargs='+', default=[], required=True)
+    add_run_args(parser, scope=None)
+    return parser.parse_args(argv)
 
-def call_with_output(command):
-    return subprocess.check_output(command, universal_newlines=True, text=True, shell=True, stderr=subprocess.STDOUT)
 
-def check_extenstion(name):
+def call_with_output(command, runner):
+    # "az vm list --subscription ..." is timed as "vm list"
+    words = command.split()[1:]
+    api = " ".join(words[:next((i for i, word in enumerate(words) if word.startswith("-")), len(words))])
+    return runner.check_output(command, api=api, stderr=subprocess.STDOUT)
+
+def check_extenstion(name, runner):
     print("Checking extension: ",name)
     success = False
     try:
-        output = call_with_output(f"az extension show -n {name}")
+        output = call_with_output(f"az extension show -n {name}", runner)
         success = True
     except subprocess.CalledProcessError as e:
         print('[Error] Error checking extension', name)
@@ -26,15 +38,19 @@ def check_extenstion(name):
         print("[Error] [Command-Output]", e.output)
 
         output = e.output
+    except subprocess.TimeoutExpired as e:
+        print('[Error] Timed out checking extension', name)
+        print("[Error] [Command]", e.cmd)
+        output = ''
 
     if f"The extension {name} is not installed" in output:
         return False
 
     return success
 
-def check_azure_subscription(subscription_id):
+def check_azure_subscription(subscription_id, runner):
     try:
-        output = call_with_output(f"az account subscription list --output json --only-show-errors")
+        output = call_with_output(f"az account subscription list --output json --only-show-errors", runner)
         for subscription in json.loads(output):
             if subscription_id == subscription["subscriptionId"]:
                 return True
@@ -43,92 +59,162 @@ def check_azure_subscription(subscription_id):
         print('[Error] Error checking subscription ', subscription_id)
         print("[Error] [Command]", e.cmd)
         print("[Error] [Command-Output]", e.output)    
+    except subprocess.TimeoutExpired as e:
+        print('[Error] Timed out checking subscription ', subscription_id)
+        print("[Error] [Command]", e.cmd)
 
     return False
 
 class SentinelOneCNSAzureUnitAudit:
-    def __init__(self, subscription):
+    def __init__(self, subscription, workers=1, runner=None, history=None, store=None, shard=None, write_csv=True):
+        self.subscription = subscription
         self.file_path = f"azure-{subscription}-units.csv" if subscription else 'azure-units.csv'
         self.subscription_flag = f'--subscription "{subscription}"'.format(subscription=subscription) if subscription else ''
+        self.workers = workers
+        self.runner = runner or CommandRunner()
+        self.history = history
+        self.store = store
+        self.shard = shard
+        self.write_csv = write_csv
 
         self.total_resource_count = 0
         self.total_workload_count = 0
+        self.lines = []
+        self.shard_services = []
+        self.shard_results = {}
+        self.result = AuditResult("azure", subscription)
 
         extensions= () # example "containerapp",
         for extension in extensions:
-            if not check_extenstion(extension):
+            if not check_extenstion(extension, self.runner):
                 raise Exception(f"Extension not installed: {extension}. Install using az extension add -n {extension}")
 
-        if not check_azure_subscription(subscription):
+        if not check_azure_subscription(subscription, self.runner):
             raise Exception(f"Check azure subscription id/permissions subscription-id: {subscription}")
 
-        with open(self.file_path, 'w') as f:
-            f.write("Resource Type, Unit Counted, Workloads\n")
+        if self.write_csv and not self.shard:
+            with open(self.file_path, 'w') as f:
+                f.write("Resource Type, Unit Counted, Workloads\n")
 
     def add_result(self, k, v, w=""):
-        with open(self.file_path, 'a') as f:
-            f.write(f'{k}, {v}, {w}\n')
+        self.lines.append(f'{k}, {v}, {w}\n')
+
+    def write_results(self):
+        if self.shard:
+            self.file_path = write_shard("azure", self.subscription, self.shard, self.shard_services, [''], self.shard_results)
+        elif self.write_csv:
+            with open(self.file_path, 'a') as f:
+                f.writelines(self.lines)
+        if self.store:
+            self.store.commit()
 
     def count_all(self):
-        self.count("Azure Virtual Machine", self.count_vm_instances, workload_multiplier=1)
-        self.count("Azure Kubernetes Cluster (AKS)", self.count_kubernetes_clusters, workload_multiplier=1)
-        self.count("Azure Container Repository", self.count_container_repository, workload_multiplier=0.1)
-        self.count("Azure Container Instances (ACI)", self.count_container_instances, workload_multiplier=0.1)
+        started = time.monotonic()
+        self.count_services([
+            ("Azure Virtual Machine", self.count_vm_instances, 1),
+            ("Azure Kubernetes Cluster (AKS)", self.count_kubernetes_clusters, 1),
+            ("Azure Container Repository", self.count_container_repository, 0.1),
+            ("Azure Container Instances (ACI)", self.count_container_instances, 0.1),
+        ])
 
         self.add_result("Total Resource", self.total_resource_count, round(self.total_workload_count))
-        print("[Info] Results stored at", self.file_path)
-
-    def count(self, svcName, svcCb, workload_multiplier):
+        self.write_results()
+        if self.write_csv or self.shard:
+            print("[Info] Results stored at", self.file_path)
+        self.result.seconds = time.monotonic() - started
+        return self.result
+
+    def count_services(self, services):
+        cells = []
+        for svcName, svcCb, _ in services:
+            key = CellHistory.key("azure", self.subscription, svcName)
+            if in_shard(key, self.shard):
+                cells.append((key, partial(self.fetch, svcName, svcCb)))
+        results = dict(zip([key for key, _ in cells], run_cells(cells, self.workers, self.history, self.runner)))
+
+        for svcName, _, workload_multiplier in services:
+            self.shard_services.append((svcName, workload_multiplier))
+            key = CellHistory.key("azure", self.subscription, svcName)
+            if key not in results:
+                continue
+            (count, error), seconds = results[key]
+            self.shard_results[(svcName, '')] = (count, error or '')
+            self.result.cells.append((svcName, '', count, error or '', seconds))
+            self.result.services.append((svcName, count, workload_multiplier, error or ''))
+            if self.store:
+                self.store.add("azure", self.subscription, '', svcName, count, workload_multiplier, error)
+            self.count(svcName, count, error, workload_multiplier)
+
+    def fetch(self, svcName, svcCb):
         try:
             count = svcCb()
-            if count:
-                workloads = count * workload_multiplier
-
-                self.total_resource_count += count
-                self.total_workload_count += workloads
-
-                self.add_result(svcName, count, workloads)
             print(f"[Info] Fetched {svcName}")
+            return count, None
         except subprocess.CalledProcessError as e:
             print('[Error] Error getting ', svcName)
             print("[Error] [Command]", e.cmd)
             print("[Error] [Command-Output]", e.output)
-            self.add_result(svcName, "Error: Check Terminal logs")
+            return 0, "Error: Check Terminal logs"
+        except subprocess.TimeoutExpired as e:
+            print('[Error] Timed out getting ', svcName)
+            print("[Error] [Command]", e.cmd)
+            return 0, "Error: Timed out"
         except json.decoder.JSONDecodeError as e:
             print("[Error] parsing data from Cloud Provider\n", e)
-            self.add_result(svcName, "JSON Error")
+            return 0, "JSON Error"
+
+    def count(self, svcName, count, error, workload_multiplier):
+        if error:
+            self.add_result(svcName, error)
+        elif count:
+            workloads = exact_workloads(count, workload_multiplier)
+
+            self.total_resource_count += count
+            self.total_workload_count += workloads
+
+            self.add_result(svcName, count, workloads)
 
     def count_vm_instances(self):
-        output = call_with_output(f"az vm list {self.subscription_flag} --output json --only-show-errors")
+        output = call_with_output(f"az vm list {self.subscription_flag} --output json --only-show-errors", self.runner)
         j = json.loads(output)
         return len(j)
 
     def count_kubernetes_clusters(self):
-        output = call_with_output(f"az aks list {self.subscription_flag} --output json --only-show-errors")
+        output = call_with_output(f"az aks list {self.subscription_flag} --output json --only-show-errors", self.runner)
         j = json.loads(output)
         return len(j)
 
     def count_container_repository(self):
-        output = call_with_output(f"az acr list {self.subscription_flag} --output json --only-show-errors")
+        output = call_with_output(f"az acr list {self.subscription_flag} --output json --only-show-errors", self.runner)
         registries = json.loads(output)
         total_repositories = 0
 
         for registry in registries:
             registryName = registry.get("name")
-            output = call_with_output(f"az acr repository list {self.subscription_flag} --name {registryName} --output json")
+            output = call_with_output(f"az acr repository list {self.subscription_flag} --name {registryName} --output json", self.runner)
             repositories = json.loads(output)
             total_repositories += len(repositories)
         return total_repositories
     
     def count_container_instances(self):
-        output = call_with_output(f"az container list {self.subscription_flag} --output json --only-show-errors")
+        output = call_with_output(f"az container list {self.subscription_flag} --output json --only-show-errors", self.runner)
         j = json.loads(output)
         return len(j)
 
-if __name__ == '__main__':
-    subscriptions = SUBSCRIPTIONS if len(SUBSCRIPTIONS) > 0 else [None]
+def main(argv=None):
+    args = parse_args(argv)
+    runner = CommandRunner(args.call_timeout, args.cell_timeout, args.hedge_factor)
+    history = CellHistory(args.history_file)
+    store = store_from_args(args)
+
+    subscriptions = args.subscriptions if len(args.subscriptions) > 0 else [None]
     for s in subscriptions:
         try:
-            SentinelOneCNSAzureUnitAudit(s).count_all()
+            SentinelOneCNSAzureUnitAudit(
+                s, workers=args.workers, runner=runner, history=history, store=store, shard=args.shard
+            ).count_all()
         except Exception as e:
             print("[Error]",e)
+
+if __name__ == '__main__':
+    main()
@@ -1,62 +1,105 @@
 import argparse
 import json
 import subprocess
+import time
 
-# Usage python3 ./digitalocean-units.py --contexts <context_1> <context_2> <context_3> <context_4>
+from units_common import AuditResult, CommandRunner, add_run_args, exact_workloads, store_from_args
 
-parser = argparse.ArgumentParser(prog="SentinelOne CNS Digital Ocean Unit Audit")
-parser.add_argument("--contexts", help="Digital Ocean CLI Contexts separated by space", nargs='+', default=[], required=False)
-args = parser.parse_args()
+# Usage python3 ./digitalocean-units.py --contexts <context_1> <context_2> <context_3> <context_4>
 
-CONTEXTS = args.contexts
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS Digital Ocean Unit Audit")
+    parser.add_argument("--contexts", help="Digital Ocean CLI Contexts separated by space", nargs='+', default=[], required=False)
+    add_run_args(parser, cells=False, shard=False)
+    return parser.parse_args(argv)
 
 class SentinelOneCNSDigitalOceanUnitAudit:
-    def __init__(self, context):
+    def __init__(self, context, runner=None, store=None, write_csv=True):
+        self.context = context
         self.file_path = "digitalocean-{context}-units.csv".format(context=context) if context else 'digitalocean-units.csv'
         self.context_flag = "--context {context}".format(context=context) if context else ''
         self.total_resource_count = 0
         self.total_workload_count = 0
+        self.lines = []
+        self.runner = runner or CommandRunner()
+        self.store = store
+        self.write_csv = write_csv
+        self.result = AuditResult("digitalocean", context)
 
-        with open(self.file_path, 'w') as f:
-            f.write("Resource Type, Unit Counted, Workloads\n")
+        if self.write_csv:
+            with open(self.file_path, 'w') as f:
+                f.write("Resource Type, Unit Counted, Workloads\n")
 
     def add_result(self, k, v, w=""):
-        with open(self.file_path, 'a') as f:
-            f.write('{k}, {v}, {w}\n'.format(k=k,v=v,w=w))
+        self.lines.append('{k}, {v}, {w}\n'.format(k=k,v=v,w=w))
+
+    def write_results(self):
+        if self.write_csv:
+            with open(self.file_path, 'a') as f:
+                f.writelines(self.lines)
+        if self.store:
+            self.store.commit()
 
     def count_all(self):
+        started = time.monotonic()
         self.count("Digital Ocean Droplets", self.count_droplets, workload_multiplier=1)
         self.add_result('TOTAL', self.total_resource_count, round(self.total_workload_count))
-        print("[Info] results stored at", self.file_path)
+        self.write_results()
+        if self.write_csv:
+            print("[Info] results stored at", self.file_path)
+        self.result.seconds = time.monotonic() - started
+        return self.result
         
     def count(self, svcName, svcCb, workload_multiplier):
+        started = time.monotonic()
         try:
             count = svcCb()
             if count:
-                workloads = count * workload_multiplier
+                workloads = exact_workloads(count, workload_multiplier)
                 self.total_resource_count += count
                 self.total_workload_count += workloads
 
                 self.add_result(svcName, count, workloads)
+            self.record(svcName, count, workload_multiplier, started)
             print('[Info] Fetched ', svcName)
         except subprocess.CalledProcessError as e:
             print('[Error] Error getting ', svcName)
             print("[Error] [Command]", e.cmd)
             print("[Error] [Command-Output]", e.output)
             self.add_result(svcName, "Error")
+            self.record(svcName, 0, workload_multiplier, started, "Error")
+        except subprocess.TimeoutExpired as e:
+            print('[Error] Timed out getting ', svcName)
+            print("[Error] [Command]", e.cmd)
+            self.add_result(svcName, "Error (Timeout)")
+            self.record(svcName, 0, workload_multiplier, started, "Error (Timeout)")
         except json.decoder.JSONDecodeError as e:
             print("[Error] parsing data from Cloud Provider\n", e)
             self.add_result(svcName, "JSON Error")
+            self.record(svcName, 0, workload_multiplier, started, "JSON Error")
+
+    def record(self, svcName, count, workload_multiplier, started, error=''):
+        self.result.cells.append((svcName, '', count, error, time.monotonic() - started))
+        self.result.services.append((svcName, count, workload_multiplier, error))
+        if self.store:
+            self.store.add("digitalocean", self.context, '', svcName, count, workload_multiplier, error)
 
     def count_droplets(self):
-      output = subprocess.check_output(
+      output = self.runner.check_output(
           f"doctl compute droplet list --output json {self.context_flag}",
-          text=True, shell=True
+          api="compute droplet list"
       )
       j = json.loads(output)
       return len(j)
 
-if __name__ == '__main__':
-    contexts = CONTEXTS if len(CONTEXTS) > 0 else [None]
+def main(argv=None):
+    args = parse_args(argv)
+    runner = CommandRunner(args.call_timeout, hedge_factor=args.hedge_factor)
+    store = store_from_args(args)
+
+    contexts = args.contexts if len(args.contexts) > 0 else [None]
     for context in contexts:
-        SentinelOneCNSDigitalOceanUnitAudit(context).count_all()
+        SentinelOneCNSDigitalOceanUnitAudit(context, runner=runner, store=store).count_all()
+
+if __name__ == '__main__':
+    main()
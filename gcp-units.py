@@ -1,30 +1,57 @@
 import argparse
 import json
+import os
 import subprocess
+import threading
+import time
+from functools import partial
+
+from units_common import (
+    AuditResult, CellHistory, CommandRunner, add_run_args, exact_workloads, in_shard, run_cells, store_from_args,
+    write_json, write_shard
+)
+
+
 
 # Usage python3 ./gcp-units.py --projects <project_id_1> <project_id_2> <project_id_3>
 
-parser = argparse.ArgumentParser(prog="SentinelOne CNS GCP Unit Audit")
-parser.add_argument("--projects", help="GCP Project ID(s) separated by space", nargs='+', default=[],required=True)
-args = parser.parse_args()
+LOCATIONS_FILE = "gcp-locations.json"
+LOCATIONS_MAX_AGE_HOURS = 24
 
-PROJECTS = args.projects
+# regional listings and the commands giving the locations they are available in
+GCP_LOCATION_COMMANDS = {
+    "functions": ("gcloud functions regions list --project {project_id} --format json", "functions regions list"),
+    "run": ("gcloud run regions list --project {project_id} --format json", "run regions list"),
+    "artifacts": ("gcloud artifacts locations list --project {project_id} --format json", "artifacts locations list"),
+}
 
-def gcloud_set_project(project_id):
-    output = subprocess.check_output(
-        f"gcloud config set project {project_id}",
-        text=True, shell=True, stderr=subprocess.STDOUT
-    )
-    print(f"[Info]: {output}")
-    if f"WARNING: You do not appear to have access to project [{project_id}] or it does not exist." in output:
+GCR_HOSTS = ["gcr.io", "us.gcr.io", "eu.gcr.io", "asia.gcr.io"]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS GCP Unit Audit")
+    parser.add_argument("--projects", help="GCP Project ID(s) separated by space", nargs='+', default=[],required=True)
+    add_run_args(parser, scope="location", workers=8)
+    parser.add_argument("--locations-file", help="File caching the locations each regional service is available in", default=LOCATIONS_FILE, required=False)
+    parser.add_argument("--locations-max-age", help="Hours before the cached locations are fetched again (0 to always fetch)", type=float, default=LOCATIONS_MAX_AGE_HOURS, required=False)
+    return parser.parse_args(argv)
+
+def gcloud_check_project(project_id, runner):
+    # every command gets --project instead of "gcloud config set project", which is shared by all gcloud processes
+    try:
+        runner.check_output(
+            f"gcloud projects describe {project_id} --format json",
+            api="projects describe", stderr=subprocess.STDOUT
+        )
+    except subprocess.CalledProcessError as e:
+        print("[Error] [Command-Output]", e.output)
         return False
     return True
 
-def gcloud_components_check():
+def gcloud_components_check(runner):
     try:
-        output = subprocess.check_output(
+        output = runner.check_output(
             "gcloud --version",
-            text=True, shell=True, stderr=subprocess.STDOUT
+            stderr=subprocess.STDOUT
         )
         installed_components = [x.split(" ")[0] for x in list(filter(lambda x: len(x.strip()) > 0, output.split("\n")))]
         requirements = {
@@ -44,10 +71,10 @@ def gcloud_components_check():
     except:
         return False
 
-def gcloud_list_services():
-    output = subprocess.check_output(
-        "gcloud services list --format json",
-        text=True, shell=True, stderr=subprocess.STDOUT
+def gcloud_list_services(project_id, runner):
+    output = runner.check_output(
+        f"gcloud services list --project {project_id} --format json",
+        api="services list", stderr=subprocess.STDOUT
     )
     services = json.loads(output)
     for service in services:
@@ -56,30 +83,112 @@ def gcloud_list_services():
             'enabled': service['state'] == 'ENABLED'
         }
 
+def location_ids(output):
+    # the regions/locations list commands return either {"locationId": ...} or {"name": ".../locations/<id>"} items
+    locations = []
+    for item in json.loads(output):
+        if isinstance(item, dict):
+            item = item.get('locationId') or item.get('name', '')
+        location = item.split('/')[-1]
+        if location and location not in locations:
+            locations.append(location)
+    return locations
+
+class GcpLocationCache:
+    # Locations of the regional services per project, kept for max_age hours so later runs skip the lookup
+    def __init__(self, path=LOCATIONS_FILE, max_age=LOCATIONS_MAX_AGE_HOURS):
+        self.path = path
+        self.max_age = max_age
+        self.locations = self.load()
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("[Error] ignoring unreadable locations file", self.path, e)
+            return {}
+
+    def get(self, project_id, service, runner):
+        # returns the locations of service, None when they could not be listed
+        key = f"{project_id}|{service}"
+        cached = self.locations.get(key)
+        if cached and time.time() - cached["fetched"] < self.max_age * 3600:
+            return cached["locations"]
+
+        command, api = GCP_LOCATION_COMMANDS[service]
+        try:
+            locations = location_ids(runner.check_output(command.format(project_id=project_id), api=api))
+        except subprocess.CalledProcessError as e:
+            print(f'[Error] Error listing {service} locations')
+            print("[Error] [Command]", e.cmd)
+            return None
+        except subprocess.TimeoutExpired as e:
+            print(f'[Error] Timed out listing {service} locations')
+            print("[Error] [Command]", e.cmd)
+            return None
+        except json.decoder.JSONDecodeError as e:
+            print(f"[Error] parsing {service} locations\n", e)
+            return None
+        if not locations:
+            return None
+
+        with self.lock:
+            self.locations[key] = {"locations": locations, "fetched": time.time()}
+        self.save()
+        return locations
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            locations = self.load()
+            locations.update(self.locations)
+            try:
+                write_json(self.path, locations)
+            except OSError as e:
+                print("[Error] could not write locations file", self.path, e)
+
 class SentinelOneCNSGCPUnitAudit:
-    def __init__(self, project_id):
+    def __init__(self, project_id, workers=8, runner=None, history=None, store=None, shard=None, locations=None,
+                 write_csv=True):
         self.existing_permissions = {}
         self.project_id = project_id
         self.file_path = f"gcp-{project_id}-units.csv"
+        self.workers = workers
+        self.runner = runner or CommandRunner()
+        self.history = history
+        self.store = store
+        self.shard = shard
+        self.locations = locations or GcpLocationCache(None)
+        self.write_csv = write_csv
         self.total_resource_count = 0
         self.total_workload_count = 0
+        self.lines = []
+        self.shard_services = []
+        self.shard_results = {}
+        self.result = AuditResult("gcp", project_id)
 
-        if not gcloud_set_project(project_id):
+        if not gcloud_check_project(project_id, self.runner):
             raise Exception("Check gcp project id/permissions")
-        print("[Info] successfully set gcloud project id:", project_id)
+        print("[Info] found gcloud project id:", project_id)
 
-        if not gcloud_components_check():
+        if not gcloud_components_check(self.runner):
             raise Exception("Check installed components")
         print("[Info] found all required cli components")
 
-        for service in gcloud_list_services():
+        for service in gcloud_list_services(project_id, self.runner):
             if service['enabled']:
                 self.existing_permissions[service['name']] = True
         print("[Info] fetched all existing permissions on account")
 
-        with open(self.file_path, 'w') as f:
-            # Write Header
-            f.write("Resource Type, Unit Counted, Workloads\n")
+        if self.write_csv and not self.shard:
+            with open(self.file_path, 'w') as f:
+                # Write Header
+                f.write("Resource Type, Unit Counted, Workloads, Error Locations\n")
 
     def is_api_enabled(self, apis):
         for api in apis:
@@ -88,99 +197,174 @@ class SentinelOneCNSGCPUnitAudit:
                 return False
         return True
 
-    def add_result(self, k, v, w=""):
-        with open(self.file_path, 'a') as f:
-            f.write(f'{k}, {v}, {w}\n')
+    def add_result(self, k, v, w, e=''):
+        self.lines.append(f'{k}, {v}, {w}, {e}\n')
+
+    def write_results(self):
+        if self.shard:
+            self.file_path = write_shard("gcp", self.project_id, self.shard, self.shard_services, self.scopes, self.shard_results)
+        elif self.write_csv:
+            with open(self.file_path, 'a') as f:
+                f.writelines(self.lines)
+        if self.store:
+            self.store.commit()
 
     def count_all(self):
-        self.count("GCP Compute Instance", self.count_compute_instances, workload_multiplier=1)
-        self.count("GCP Kubernetes Cluster (GKE)", self.count_kubernetes_clusters, workload_multiplier=1)
-        self.count("GCP Cloud Function", self.count_cloud_functions, workload_multiplier=0.02)
-        self.count("GCP Cloud Run", self.count_cloud_run, workload_multiplier=0.02)
-        self.count("GCP Artifact Repository (only docker repositories)", self.count_artifact_repository_docker, workload_multiplier=0.1)
-        self.count("GCP Container Repository", self.count_container_repository, workload_multiplier=0.1)
+        started = time.monotonic()
+        self.count_services([
+            ("GCP Compute Instance", self.count_compute_instances, 1, ['']),
+            ("GCP Kubernetes Cluster (GKE)", self.count_kubernetes_clusters, 1, ['']),
+            ("GCP Cloud Function", self.count_cloud_functions, 0.02,
+                self.get_locations("functions", "cloudfunctions.googleapis.com", GCP_CF_LOCATIONS)),
+            ("GCP Cloud Run", self.count_cloud_run, 0.02,
+                self.get_locations("run", "run.googleapis.com")),
+            ("GCP Artifact Repository (only docker repositories)", self.count_artifact_repository_docker, 0.1,
+                self.get_locations("artifacts", "artifactregistry.googleapis.com")),
+            ("GCP Container Repository", self.count_container_repository, 0.1,
+                GCR_HOSTS if self.is_api_enabled(["storage-api.googleapis.com"]) else ['']),
+        ])
 
         self.add_result('TOTAL', self.total_resource_count, round(self.total_workload_count))
-        print("[Info] results stored at", self.file_path)
+        self.write_results()
+        if self.write_csv or self.shard:
+            print("[Info] results stored at", self.file_path)
+        self.result.seconds = time.monotonic() - started
+        return self.result
+
+    def get_locations(self, service, api, fallback=('',)):
+        # [''] lists the service in one call, as done when its locations are unknown
+        if not self.is_api_enabled([api]):
+            return ['']
+        locations = self.locations.get(self.project_id, service, self.runner)
+        if locations is None:
+            print(f"[Info] listing {service} without its locations")
+            return list(fallback)
+        print(f"[Info] {service} available in {len(locations)} locations")
+        return locations
+
+    def count_services(self, services):
+        self.scopes = {svcName: locations for svcName, _, _, locations in services}
+        cells = []
+        for svcName, svcCb, _, locations in services:
+            for location in locations:
+                key = CellHistory.key("gcp", self.project_id, svcName, location)
+                if in_shard(key, self.shard):
+                    cells.append((key, partial(self.count_location, svcName, svcCb, location)))
+        results = dict(zip([key for key, _ in cells], run_cells(cells, self.workers, self.history, self.runner)))
 
-    def count(self, svcName, svcCb, workload_multiplier):
+        for svcName, _, workload_multiplier, locations in services:
+            self.shard_services.append((svcName, workload_multiplier))
+            count = 0
+            error = ''
+            for location in locations:
+                key = CellHistory.key("gcp", self.project_id, svcName, location)
+                if key not in results:
+                    continue
+                (location_count, location_error), seconds = results[key]
+                self.shard_results[(svcName, location)] = (location_count, location_error)
+                self.result.cells.append((svcName, location, location_count, location_error, seconds))
+                if self.store:
+                    self.store.add("gcp", self.project_id, location, svcName, location_count, workload_multiplier, location_error)
+                count += location_count
+                error += location_error
+            self.result.services.append((svcName, count, workload_multiplier, error))
+            self.count(svcName, count, error, workload_multiplier)
+
+    def count_location(self, svcName, svcCb, location):
+        name = location or 'global'
         try:
-            count = svcCb()
-            if count:
-                workloads = count * workload_multiplier
-                self.total_workload_count +=  workloads
-                self.total_resource_count += count
-                self.add_result(svcName, count, workloads)
-            print('[Info] Fetched ', svcName)
+            count = svcCb(location)
+            error = ''
         except subprocess.CalledProcessError as e:
-            print('[Error] Error getting ', svcName)
+            print('[Error] Error getting ', svcName, name)
             print("[Error] [Command]", e.cmd)
             # print("[Error] [Command-Output]", e.output)
-            self.add_result(svcName, "Error")
+            count = 0
+            error = f"{name}, "
+        except subprocess.TimeoutExpired as e:
+            print('[Error] Timed out getting ', svcName, name)
+            print("[Error] [Command]", e.cmd)
+            count = 0
+            error = f"{name} (Timeout), "
         except json.decoder.JSONDecodeError as e:
             print("[Error] parsing data from Cloud Provider\n", e)
-            self.add_result(svcName, "Error")
+            count = 0
+            error = f"{name} (Json Error), "
+        print(f'[Info] Fetched {svcName} - {name}')
+        return count, error
 
-    def count_compute_instances(self):
+    def count(self, svcName, count, error, workload_multiplier):
+        if count or error != '':
+            workloads = exact_workloads(count, workload_multiplier)
+            self.total_workload_count +=  workloads
+            self.total_resource_count += count
+            self.add_result(svcName, count, workloads, error)
+
+    def count_compute_instances(self, location):
         if not self.is_api_enabled(["compute.googleapis.com"]):
             return 0
-        output = subprocess.check_output(
-            "gcloud compute instances list --format json",
-            text=True, shell=True, 
+        output = self.runner.check_output(
+            f"gcloud compute instances list --project {self.project_id} --format json",
+            api="compute instances list"
         )
         j = json.loads(output)
         return len(j)
 
-    def count_kubernetes_clusters(self):
+    def count_kubernetes_clusters(self, location):
         if not self.is_api_enabled(["container.googleapis.com"]):
             return 0
-        output = subprocess.check_output(
-            "gcloud container clusters list --format json",
-            text=True, shell=True, 
+        output = self.runner.check_output(
+            f"gcloud container clusters list --project {self.project_id} --format json",
+            api="container clusters list"
         )
         j = json.loads(output)
         return len(j)
 
-    def count_cloud_functions(self):
+    def count_cloud_functions(self, location):
         if not self.is_api_enabled(["cloudfunctions.googleapis.com"]):
             return 0
-        output = subprocess.check_output(
-            f"gcloud functions list --regions={','.join(GCP_CF_LOCATIONS)} --format json",
-            text=True, shell=True, 
+        output = self.runner.check_output(
+            f"gcloud functions list --project {self.project_id} --regions={location} --format json",
+            api="functions list"
         )
         j = json.loads(output)
         return len(j)
 
-    def count_cloud_run(self):
+    def count_cloud_run(self, location):
         if not self.is_api_enabled(["run.googleapis.com"]):
             return 0
-        output = subprocess.check_output(
-            f"gcloud run services list --format json",
-            text=True, shell=True, 
+        region_flag = f"--region={location}" if location else ''
+        output = self.runner.check_output(
+            f"gcloud run services list --project {self.project_id} {region_flag} --format json",
+            api="run services list"
         )
         j = json.loads(output)
         return len(j)
 
-    def count_artifact_repository_docker(self):
+    def count_artifact_repository_docker(self, location):
         if not self.is_api_enabled(["artifactregistry.googleapis.com"]):
             return 0
-        output = subprocess.check_output(
-            f"gcloud artifacts repositories list --filter=\"format=docker\" --format json",
-            universal_newlines=True, text=True, shell=True,
+        location_flag = f"--location={location}" if location else ''
+        output = self.runner.check_output(
+            f"gcloud artifacts repositories list --project {self.project_id} {location_flag} --filter=\"format=docker\" --format json",
+            api="artifacts repositories list"
         )
         j = json.loads(output)
         return len(j)
 
-    def count_container_repository(self):
+    def count_container_repository(self, host):
         if not self.is_api_enabled(["storage-api.googleapis.com"]):
             return 0
-        output = subprocess.check_output(
-            f"gcloud container images list --format json",
-            text=True, shell=True
+        # domain scoped projects (example.com:project) live under gcr.io/example.com/project
+        repository_flag = f"--repository={host}/{self.project_id.replace(':', '/')}" if host else ''
+        output = self.runner.check_output(
+            f"gcloud container images list --project {self.project_id} {repository_flag} --format json",
+            api="container images list"
         )
         j = json.loads(output)
         return len(j)
 
+# used when the functions regions can not be listed
 GCP_CF_LOCATIONS = [
     'us-west1',
     'us-central1',
@@ -207,10 +391,22 @@ GCP_CF_LOCATIONS = [
     'asia-northeast3'
 ]
 
-if __name__ == '__main__':
-    projects = PROJECTS if len(PROJECTS) > 0 else [None]
+def main(argv=None):
+    args = parse_args(argv)
+    runner = CommandRunner(args.call_timeout, args.cell_timeout, args.hedge_factor)
+    history = CellHistory(args.history_file)
+    locations = GcpLocationCache(args.locations_file, args.locations_max_age)
+    store = store_from_args(args)
+
+    projects = args.projects if len(args.projects) > 0 else [None]
     for projectId in projects:
         try:
-            SentinelOneCNSGCPUnitAudit(projectId).count_all()
+            SentinelOneCNSGCPUnitAudit(
+                projectId, workers=args.workers, runner=runner, history=history, store=store, shard=args.shard,
+                locations=locations
+            ).count_all()
         except Exception as e:
             print("[Error]", e)
+
+if __name__ == '__main__':
+    main()
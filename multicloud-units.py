@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+
+from units_common import CellHistory, default_run_id
+
+# Usage python3 ./multicloud-units.py --config multicloud.json
+#
+# multicloud.json lists the accounts to audit per provider, eg.
+# {
+#   "workers": 16,
+#   "aws": {"profiles": ["default", "prod"], "regions": [], "workers": 4, "max_workers": 8},
+#   "azure": {"subscriptions": ["<subscription_id>"]},
+#   "gcp": {"projects": ["<project_id>"], "workers": 3},
+#   "oci": {"profiles": ["DEFAULT"], "compartments": [], "args": ["--auth security_token"]},
+#   "alibaba": {"profiles": ["default"]},
+#   "digitalocean": {"contexts": ["default"]}
+# }
+# "workers" is the global budget of cli calls running at the same time, a provider's "workers" is used for each
+# of its accounts and "max_workers" caps the calls running against that provider. Hedged calls are turned off so they
+# do not go over the budget. "script_args" are passed as is.
+# With "db": "units.db" every account's results are also stored in that sqlite file under one run id.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_WORKERS = 8
+
+# provider: (script, config key with the accounts, flag of the accounts, other list options and their flags)
+PROVIDERS = {
+    "aws": ("aws-units.py", "profiles", "--profiles", {"regions": "--regions"}),
+    "azure": ("azure-units.py", "subscriptions", "--subscriptions", {}),
+    "gcp": ("gcp-units.py", "projects", "--projects", {}),
+    "oci": ("oci-units.py", "profiles", "--profiles", {"compartments": "--compartments", "args": "--args"}),
+    "alibaba": ("alibaba-units.py", "profiles", "--profiles", {"regions": "--regions"}),
+    "digitalocean": ("digitalocean-units.py", "contexts", "--contexts", {}),
+}
+
+# digitalocean-units.py fetches one service at a time
+SINGLE_WORKER_PROVIDERS = ("digitalocean",)
+
+
+class Job:
+    def __init__(self, provider, account, settings, budget, store_args):
+        script, _, account_flag, options = PROVIDERS[provider]
+        self.provider = provider
+        self.account = account
+        self.file_path = f"{provider}-{account}-units.csv" if account else f"{provider}-units.csv"
+        self.log_path = self.file_path[:-len(".csv")] + ".log"
+
+        cap = min(settings.get("max_workers", budget), budget)
+        workers = settings.get("workers", 1)
+        if provider in SINGLE_WORKER_PROVIDERS:
+            workers = 1
+        # a job asking for more than the provider may ever use would never start
+        self.workers = max(1, min(workers, cap))
+
+        self.command = [sys.executable, os.path.join(SCRIPTS_DIR, script)]
+        if account:
+            self.command += [account_flag, account]
+        for option, flag in options.items():
+            if settings.get(option):
+                self.command += [flag] + settings[option]
+        if provider not in SINGLE_WORKER_PROVIDERS:
+            self.command += ["--workers", str(self.workers)]
+        # a hedged call is one more call running than the workers the job was given
+        self.command += ["--hedge-factor", "0"]
+        self.command += store_args
+        self.command += settings.get("script_args", [])
+
+        self.proc = None
+        self.log = None
+        self.started = None
+
+    def estimate(self, account_seconds):
+        return account_seconds.get((self.provider, self.account or ''), 0) / self.workers
+
+    def start(self):
+        print(f"[Info] Starting {self.provider} {self.account or 'default'} with {self.workers} worker(s)")
+        # a csv left over from an earlier run must not be taken for this run's results
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+        self.log = open(self.log_path, 'w')
+        self.started = time.monotonic()
+        self.proc = subprocess.Popen(self.command, stdout=self.log, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def finished(self):
+        if self.proc.poll() is None:
+            return False
+        self.log.close()
+        print(f"[Info] Finished {self.provider} {self.account or 'default'} in {time.monotonic() - self.started:.0f}s, logs at {self.log_path}")
+        return True
+
+
+def read_total(file_path):
+    # returns (units, workloads) summed from the service rows of a script's csv, None if the script did not get to
+    # the TOTAL row. The TOTAL row itself has the workloads rounded, which must not be added up across accounts.
+    units = 0
+    workloads = Decimal(0)
+    try:
+        with open(file_path) as f:
+            next(f)
+            for line in f:
+                row = [c.strip() for c in line.split(",")]
+                if row[0] in ("TOTAL", "Total Resource"):
+                    return units, workloads
+                # services that failed without an error column have the error in place of the count
+                if row[1].isdigit():
+                    units += int(row[1])
+                    workloads += Decimal(row[2])
+    except (OSError, IndexError, InvalidOperation, StopIteration):
+        pass
+    return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS Multi Cloud Unit Audit")
+    parser.add_argument("--config", help="JSON file listing the accounts to audit per provider", required=True)
+    parser.add_argument("--output", help="File to write the combined totals to", default="multicloud-units.csv", required=False)
+    return parser.parse_args(argv)
+
+
+def load_jobs(config):
+    budget = config.get("workers", DEFAULT_WORKERS)
+    # with nothing to run jobs on, run_jobs would wait forever
+    if budget < 1:
+        raise Exception(f'"workers" must be at least 1, got {budget}')
+    store_args = ["--db", config["db"], "--run-id", default_run_id()] if config.get("db") else []
+    jobs = []
+    caps = {}
+    for provider, (_, accounts_key, _, _) in PROVIDERS.items():
+        if provider not in config:
+            continue
+        settings = config[provider]
+        if settings.get("max_workers", budget) < 1:
+            raise Exception(f'{provider} "max_workers" must be at least 1, got {settings["max_workers"]}')
+        accounts = settings.get(accounts_key) or [None]
+        caps[provider] = min(settings.get("max_workers", budget), budget)
+        for account in accounts:
+            jobs.append(Job(provider, account, settings, budget, store_args))
+    return jobs, budget, caps
+
+
+def run_jobs(jobs, budget, caps):
+    history = CellHistory()
+    account_seconds = {}
+    for key, seconds in history.durations.items():
+        provider, account, _ = key.split("|", 2)
+        account_seconds[(provider, account)] = account_seconds.get((provider, account), 0) + seconds
+    # longest accounts first, so a big account does not start last
+    pending = sorted(jobs, key=lambda job: job.estimate(account_seconds), reverse=True)
+    running = []
+    used = {provider: 0 for provider in caps}
+
+    while pending or running:
+        for job in list(pending):
+            in_use = sum(used.values())
+            if in_use + job.workers > budget or used[job.provider] + job.workers > caps[job.provider]:
+                continue
+            job.start()
+            used[job.provider] += job.workers
+            running.append(job)
+            pending.remove(job)
+
+        time.sleep(0.5)
+        for job in list(running):
+            if job.finished():
+                used[job.provider] -= job.workers
+                running.remove(job)
+
+
+def write_combined(jobs, file_path):
+    total_units = 0
+    total_workloads = 0
+    with open(file_path, 'w') as f:
+        f.write("Provider, Account, Unit Counted, Workloads, Results\n")
+        for job in jobs:
+            total = read_total(job.file_path)
+            if total is None:
+                print(f"[Error] no results for {job.provider} {job.account or 'default'}, check {job.log_path}")
+                f.write(f"{job.provider}, {job.account or ''}, , , Error: check {job.log_path}\n")
+                continue
+            units, workloads = total
+            total_units += units
+            total_workloads += workloads
+            f.write(f"{job.provider}, {job.account or ''}, {units}, {workloads}, {job.file_path}\n")
+        f.write(f"TOTAL, , {total_units}, {round(total_workloads)}, \n")
+    print("[Info] Combined results stored at", file_path)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.config) as f:
+        config = json.load(f)
+    jobs, budget, caps = load_jobs(config)
+    run_jobs(jobs, budget, caps)
+    write_combined(jobs, args.output)
+
+
+if __name__ == '__main__':
+    main()
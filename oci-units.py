@@ -1,60 +1,130 @@
 import argparse
 import json
 import subprocess
+import time
+from functools import partial
+
+from units_common import (
+    AuditResult, CellHistory, CommandRunner, add_run_args, exact_workloads, in_shard, run_cells, store_from_args,
+    write_shard
+)
 
-# Usage python3 ./oci-units.py --profiles profile_1 profile_2 profile_3 --compartments compartment_1 compartment_2 --args "--auth security_token"
-parser = argparse.ArgumentParser(prog="SentinelOne CNS OCI Unit Audit")
 
-parser.add_argument("--profiles", help="OCI profile(s) separated by space", nargs='+', default=[], required=False)
-parser.add_argument("--compartments", help="Compartments to run script for", nargs='+', default=[], required=False)
-parser.add_argument("--args", help="OCI CLI aditional args", nargs='+', default=[], required=False)
 
-args = parser.parse_args()
+# Usage python3 ./oci-units.py --profiles profile_1 profile_2 profile_3 --compartments compartment_1 compartment_2 --args "--auth security_token"
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS OCI Unit Audit")
 
-ADITIONAL_ARGS = " ".join(args.args)
-PROFILES = args.profiles
-COMPARTMENTS = args.compartments
+    parser.add_argument("--profiles", help="OCI profile(s) separated by space", nargs='+', default=[], required=False)
+    parser.add_argument("--compartments", help="Compartments to run script for", nargs='+', default=[], required=False)
+    parser.add_argument("--args", help="OCI CLI aditional args", nargs='+', default=[], required=False)
+    add_run_args(parser, scope="compartment")
+    return parser.parse_args(argv)
 
 class SentinelOneCNSOCIUnitAudit:
-    def __init__(self, profile):
+    def __init__(self, profile, compartments=(), additional_args='', workers=1, runner=None, history=None, store=None,
+                 shard=None, write_csv=True):
+        self.profile = profile
         self.file_path = "oci-{profile}-units.csv".format(profile=profile) if profile else 'oci-units.csv'
         self.profile_flag = "--profile {profile}".format(profile=profile) if profile else ''
+        self.compartment_ids = compartments
+        self.additional_args = additional_args
+        self.workers = workers
+        self.runner = runner or CommandRunner()
+        self.history = history
+        self.store = store
+        self.shard = shard
+        self.write_csv = write_csv
 
         self.total_resource_count = 0
         self.total_workload_count = 0
+        self.lines = []
+        self.shard_services = []
+        self.shard_results = {}
+        self.result = AuditResult("oci", profile)
         
-        with open(self.file_path, 'w') as f:
-            f.write("Resource Type, Unit Counted, Workloads, Error Compartments\n")
+        if self.write_csv and not self.shard:
+            with open(self.file_path, 'w') as f:
+                f.write("Resource Type, Unit Counted, Workloads, Error Compartments\n")
 
     def add_result(self, k, v, w, e=''):
-        with open(self.file_path, 'a') as f:
-            f.write('{k}, {v}, {w}, {e}\n'.format(k=k,v=v,w=w,e=e))
+        self.lines.append('{k}, {v}, {w}, {e}\n'.format(k=k,v=v,w=w,e=e))
+
+    def write_results(self):
+        if self.shard:
+            self.file_path = write_shard("oci", self.profile, self.shard, self.shard_services, list(self.compartments), self.shard_results)
+        elif self.write_csv:
+            with open(self.file_path, 'a') as f:
+                f.writelines(self.lines)
+        if self.store:
+            self.store.commit()
 
     def count_all(self):
+        started = time.monotonic()
         self.compartments = self.get_compartments()
-        self.count("Oracle Compute Instance", self.count_compute_instance, workload_multiplier=1)
-        self.count("Oracle Kubernetes Cluster", self.count_kubernetes_cluster, workload_multiplier=1)
+        self.count_services([
+            ("Oracle Compute Instance", self.count_compute_instance, 1),
+            ("Oracle Kubernetes Cluster", self.count_kubernetes_cluster, 1),
+        ])
 
         self.add_result('TOTAL', self.total_resource_count, round(self.total_workload_count))
-        print("[Info] Results stored at", self.file_path)
-
-    def count(self, svcName, svcCb, workload_multiplier):
-        count = 0
-        error = ''
-        for compartmentId, compartmentName in self.compartments.items():
-            try:
-                count += svcCb(compartmentId)
-            except subprocess.CalledProcessError as e:
-                print('[Error] Error getting ', svcName)
-                print("[Error] [Command]", e.cmd)
-                print("[Error] [Command-Output]", e.output)
-                error += f"{compartmentId}, "
-            except json.decoder.JSONDecodeError as e:
-                print("[Error] parsing data from Cloud Provider\n", e)
-                error += f"{compartmentId} (JSON), "
-            print(f'[Info] Fetched {compartmentName} - {svcName}')
-        
-        workloads = count * workload_multiplier
+        self.write_results()
+        if self.write_csv or self.shard:
+            print("[Info] Results stored at", self.file_path)
+        self.result.seconds = time.monotonic() - started
+        return self.result
+
+    def count_services(self, services):
+        cells = []
+        for svcName, svcCb, _ in services:
+            for compartmentId, compartmentName in self.compartments.items():
+                key = CellHistory.key("oci", self.profile, svcName, compartmentId)
+                if in_shard(key, self.shard):
+                    cells.append((key, partial(self.count_compartment, svcName, svcCb, compartmentId, compartmentName)))
+        results = dict(zip([key for key, _ in cells], run_cells(cells, self.workers, self.history, self.runner)))
+
+        for svcName, _, workload_multiplier in services:
+            self.shard_services.append((svcName, workload_multiplier))
+            count = 0
+            error = ''
+            for compartmentId in self.compartments:
+                key = CellHistory.key("oci", self.profile, svcName, compartmentId)
+                if key not in results:
+                    continue
+                (compartment_count, compartment_error), seconds = results[key]
+                self.shard_results[(svcName, compartmentId)] = (compartment_count, compartment_error)
+                self.result.cells.append((svcName, compartmentId, compartment_count, compartment_error, seconds))
+                if self.store:
+                    self.store.add("oci", self.profile, compartmentId, svcName, compartment_count, workload_multiplier, compartment_error)
+                count += compartment_count
+                error += compartment_error
+            self.result.services.append((svcName, count, workload_multiplier, error))
+            self.count(svcName, count, error, workload_multiplier)
+
+    def count_compartment(self, svcName, svcCb, compartmentId, compartmentName):
+        try:
+            count = svcCb(compartmentId)
+            error = ''
+        except subprocess.CalledProcessError as e:
+            print('[Error] Error getting ', svcName)
+            print("[Error] [Command]", e.cmd)
+            print("[Error] [Command-Output]", e.output)
+            count = 0
+            error = f"{compartmentId}, "
+        except subprocess.TimeoutExpired as e:
+            print('[Error] Timed out getting ', svcName)
+            print("[Error] [Command]", e.cmd)
+            count = 0
+            error = f"{compartmentId} (Timeout), "
+        except json.decoder.JSONDecodeError as e:
+            print("[Error] parsing data from Cloud Provider\n", e)
+            count = 0
+            error = f"{compartmentId} (JSON), "
+        print(f'[Info] Fetched {compartmentName} - {svcName}')
+        return count, error
+
+    def count(self, svcName, count, error, workload_multiplier):
+        workloads = exact_workloads(count, workload_multiplier)
         self.total_workload_count += workloads
         self.total_resource_count += count
         self.add_result(svcName, count, workloads, error)
@@ -62,9 +132,9 @@ class SentinelOneCNSOCIUnitAudit:
     def get_compartments(self):
         print("[Info] Fetching Compartments")
         try:
-            output = subprocess.check_output(
-                f"oci iam compartment list --all --include-root --compartment-id-in-subtree true --access-level ACCESSIBLE --lifecycle-state ACTIVE --output json {ADITIONAL_ARGS}",
-                    text=True, shell=True
+            output = self.runner.check_output(
+                f"oci iam compartment list --all --include-root --compartment-id-in-subtree true --access-level ACCESSIBLE --lifecycle-state ACTIVE --output json {self.additional_args}",
+                    api="iam compartment list"
                 )
             j = json.loads(output)
             compartments = {}
@@ -72,21 +142,24 @@ class SentinelOneCNSOCIUnitAudit:
             for i in j.get('data'):
                 compartments[i.get("id")] = i.get("name")
 
-            # when COMPARTMENTS are passed manually, returning only mentioned comartmentIds with name
-            if len(COMPARTMENTS) != 0:
-                return {key: val for key, val in compartments.items() if key in COMPARTMENTS}
+            # when compartments are passed manually, returning only mentioned comartmentIds with name
+            if len(self.compartment_ids) != 0:
+                return {key: val for key, val in compartments.items() if key in self.compartment_ids}
 
             return compartments
+        # without its compartments nothing of the profile can be counted, it must not look like an empty profile
         except subprocess.CalledProcessError as e:
-            print('[Error] Error getting Compartments', )
             print("[Error] [Command]", e.cmd)
             print("[Error] [Command-Output]", e.output)
-            return {}
+            raise Exception(f"could not get the compartments of oci profile {self.profile or 'default'}")
+        except subprocess.TimeoutExpired as e:
+            print("[Error] [Command]", e.cmd)
+            raise Exception(f"timed out getting the compartments of oci profile {self.profile or 'default'}")
 
     def count_compute_instance(self, compartmentId):
-      output = subprocess.check_output(
-          f"oci compute instance list --all --output json --compartment-id {compartmentId} {self.profile_flag} {ADITIONAL_ARGS}",
-          text=True, shell=True
+      output = self.runner.check_output(
+          f"oci compute instance list --all --output json --compartment-id {compartmentId} {self.profile_flag} {self.additional_args}",
+          api="compute instance list"
       )
       if output == None or output == "":
           return 0
@@ -94,16 +167,30 @@ class SentinelOneCNSOCIUnitAudit:
       return len(j.get('data'))
 
     def count_kubernetes_cluster(self, compartmentId):
-      output = subprocess.check_output(
-          f"oci ce cluster list --all --output json --compartment-id {compartmentId} {self.profile_flag} {ADITIONAL_ARGS}",
-          text=True, shell=True
+      output = self.runner.check_output(
+          f"oci ce cluster list --all --output json --compartment-id {compartmentId} {self.profile_flag} {self.additional_args}",
+          api="ce cluster list"
       )
       if output == None or output == "":
           return 0
       j = json.loads(output)
       return len(j.get('data'))
 
-if __name__ == '__main__':
-    profiles = PROFILES if len(PROFILES) > 0 else [None]
+def main(argv=None):
+    args = parse_args(argv)
+    runner = CommandRunner(args.call_timeout, args.cell_timeout, args.hedge_factor)
+    history = CellHistory(args.history_file)
+    store = store_from_args(args)
+
+    profiles = args.profiles if len(args.profiles) > 0 else [None]
     for p in profiles:
-        SentinelOneCNSOCIUnitAudit(p).count_all()
+        try:
+            SentinelOneCNSOCIUnitAudit(
+                p, compartments=args.compartments, additional_args=" ".join(args.args), workers=args.workers, runner=runner,
+                history=history, store=store, shard=args.shard
+            ).count_all()
+        except Exception as e:
+            print("[Error]", e)
+
+if __name__ == '__main__':
+    main()
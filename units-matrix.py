@@ -0,0 +1,150 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+from itertools import groupby
+
+from units_common import (
+    MATRIX_FILE, ROLLUP_LEVELS, CountMatrix, latest_run, merge_matrices, read_matrix, rollup, stored_pruned_regions,
+    write_matrix
+)
+
+# Usage python3 ./units-matrix.py build --db units.db --run <run_id> --output units-matrix.jsonl
+#       python3 ./units-matrix.py build --shards [shard_file_1 shard_file_2 ...] --output units-matrix.jsonl
+#       python3 ./units-matrix.py merge <matrix_1> <matrix_2> --output units-matrix.jsonl
+#       python3 ./units-matrix.py rollup units-matrix.jsonl --by service region account
+# A matrix file keeps the per region/compartment counts of many accounts as integers, one line per account, so
+# files can be merged and rolled up one account at a time without reading the per account csv files.
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS Unit Matrix")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="Write a matrix file from a --db store run or from shard files")
+    source = build_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--db", help="SQLite file written by the scripts' --db option", default=None)
+    source.add_argument("--shards", help="Shard files written by the scripts' --shard option (default: all in the current directory)", nargs='*', default=None)
+    build_parser.add_argument("--run", help="Run of the --db store (default: latest)", default=None, required=False)
+    build_parser.add_argument("--output", help="Matrix file to write", default=MATRIX_FILE, required=False)
+
+    merge_parser = commands.add_parser("merge", help="Merge matrix files of other runs or shards, later files win for the same cell")
+    merge_parser.add_argument("files", help="Matrix files to merge", nargs='+')
+    merge_parser.add_argument("--output", help="Matrix file to write", default=MATRIX_FILE, required=False)
+
+    rollup_parser = commands.add_parser("rollup", help="Sum the units and workloads of a matrix file")
+    rollup_parser.add_argument("file", help="Matrix file to roll up", nargs='?', default=MATRIX_FILE)
+    rollup_parser.add_argument("--by", help="Levels to sum by, all in one pass over the file", nargs='+', choices=ROLLUP_LEVELS, default=["service"], required=False)
+    return parser.parse_args(argv)
+
+
+def build_from_store(db_path, run, out_path):
+    if not os.path.exists(db_path):
+        raise Exception(f"no results store at {db_path}, run the scripts with --db {db_path} first")
+    db = sqlite3.connect(db_path)
+    try:
+        if run is None:
+            run = latest_run(db)
+
+        matrix = CountMatrix()
+        for provider, service, workload_multiplier in db.execute(
+                "SELECT provider, service, workload_multiplier FROM results WHERE run = ? "
+                "GROUP BY provider, service ORDER BY MIN(rowid)", (run,)):
+            matrix.service(provider, service, workload_multiplier)
+
+        # one account's rows at a time, in the order the script added them
+        rows = db.execute(
+            "SELECT provider, account, service, scope, count, workload_multiplier, error FROM results "
+            "WHERE run = ? ORDER BY provider, account, rowid", (run,))
+        accounts = (
+            matrix.account_from_cells(
+                provider, account, [row[2:] for row in account_rows], stored_pruned_regions(db, run, provider, account)
+            )
+            for (provider, account), account_rows in groupby(rows, key=lambda row: (row[0], row[1]))
+        )
+        write_matrix(out_path, matrix, accounts)
+    finally:
+        db.close()
+    print(f"[Info] Run {run} stored at", out_path)
+
+
+def load_shard(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def build_from_shards(files, out_path):
+    files = files or sorted(glob.glob("*-units.shard-*-of-*.json"))
+    if not files:
+        raise Exception("no shard files found")
+
+    # first pass for the services and the accounts, the cells are only read one account at a time
+    matrix = CountMatrix()
+    accounts = {}
+    for file_path in files:
+        shard = load_shard(file_path)
+        for svcName, workload_multiplier in shard["services"]:
+            matrix.service(shard["provider"], svcName, workload_multiplier)
+        accounts.setdefault((shard["provider"], shard["account"] or ''), []).append(file_path)
+
+    def account_counts():
+        for (provider, account), account_files in sorted(accounts.items()):
+            cells = []
+            pruned_regions = None
+            for file_path in account_files:
+                shard = load_shard(file_path)
+                multipliers = dict(shard["services"])
+                cells += [(svcName, scope, count, multipliers[svcName], error) for svcName, scope, count, error in shard["cells"]]
+                pruned_regions = shard.get("pruned_regions", pruned_regions)
+            yield matrix.account_from_cells(provider, account, cells, pruned_regions)
+
+    write_matrix(out_path, matrix, account_counts())
+    print(f"[Info] {len(files)} shard file(s) stored at", out_path)
+
+
+LEVEL_COLUMNS = {
+    "provider": ["Provider"],
+    "account": ["Provider", "Account"],
+    "region": ["Provider", "Region"],
+    "service": ["Provider", "Resource Type"],
+}
+
+
+def key_names(level, key):
+    # accounts run without a profile/context and services without regions have an empty name
+    empty = {"account": "default", "region": "global"}.get(level, '')
+    return [name or empty for name in key]
+
+
+def print_rollups(file_path, levels):
+    matrix, accounts = read_matrix(file_path)
+    rollups = rollup(matrix, accounts, levels)
+    for n, level in enumerate(levels):
+        if n:
+            print()
+        columns = LEVEL_COLUMNS[level]
+        print(f"{', '.join(columns)}, Unit Counted, Workloads, Errors")
+        total_count = 0
+        total_workloads = 0
+        for key, count, workloads, errors in rollups[level]:
+            total_count += count
+            total_workloads += workloads
+            print(f"{', '.join(key_names(level, key))}, {count}, {workloads}, {errors}")
+        print(f"TOTAL, {', ' * (len(columns) - 1)}{total_count}, {round(total_workloads)}, ")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "build":
+        if args.db:
+            build_from_store(args.db, args.run, args.output)
+        else:
+            build_from_shards(args.shards, args.output)
+    elif args.command == "merge":
+        merge_matrices(args.files, args.output)
+        print("[Info] Merged matrix stored at", args.output)
+    elif args.command == "rollup":
+        print_rollups(args.file, args.by)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import glob
+import json
+
+from units_common import CellHistory, csv_lines, shard_of
+
+# Usage python3 ./units-merge.py [shard_file_1 shard_file_2 ...]
+# Merges the shard files written by the scripts' --shard i/N option into the {provider}-{account}-units.csv
+# files a run without --shard would have written. Without arguments, merges the shard files in the current directory.
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS Unit Shard Merge")
+    parser.add_argument("files", help="Shard files to merge", nargs='*', default=[])
+    return parser.parse_args(argv)
+
+
+def load_shards(files):
+    # {(provider, account): {shard index: shard}}
+    accounts = {}
+    for file_path in files:
+        with open(file_path) as f:
+            shard = json.load(f)
+        accounts.setdefault((shard["provider"], shard["account"]), {})[shard["shard"][0]] = shard
+    return accounts
+
+
+def merge_account(provider, account, shards):
+    totals = {shard["shard"][1] for shard in shards.values()}
+    if len(totals) != 1:
+        print(f"[Error] {provider} {account or 'default'}: shard files of different shard counts {sorted(totals)}")
+        return None
+    total = totals.pop()
+    missing = [i for i in range(1, total + 1) if i not in shards]
+    if missing:
+        print(f"[Error] {provider} {account or 'default'}: missing shard(s) {missing} of {total}, rerun them with --shard i/{total}")
+        return None
+
+    # every shard listed the same services and regions/compartments, unless they changed between the shard runs
+    first = shards[min(shards)]
+    services = first["services"]
+    scopes = first["scopes"]
+    for shard in shards.values():
+        if shard["services"] != services or shard["scopes"] != scopes or shard.get("pruned_regions") != first.get("pruned_regions"):
+            print(f"[Error] {provider} {account or 'default'}: shards found different services or regions, rerun all shards")
+            return None
+
+    cells = {}
+    for shard in shards.values():
+        for svcName, scope, count, error in shard["cells"]:
+            cells[(svcName, scope)] = (count, error)
+
+    merged = []
+    incomplete = set()
+    for svcName, workload_multiplier in services:
+        count = 0
+        error = ''
+        for scope in (scopes[svcName] if isinstance(scopes, dict) else scopes):
+            if (svcName, scope) not in cells:
+                incomplete.add(shard_of(CellHistory.key(provider, account, svcName, scope), total))
+                continue
+            scope_count, scope_error = cells[(svcName, scope)]
+            count += scope_count
+            error += scope_error
+        merged.append((svcName, count, workload_multiplier, error))
+    if incomplete:
+        print(f"[Error] {provider} {account or 'default'}: shard(s) {sorted(incomplete)} of {total} did not finish, rerun them")
+        return None
+    return merged, first.get("pruned_regions")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    files = args.files or sorted(glob.glob("*-units.shard-*-of-*.json"))
+    if not files:
+        print("[Error] no shard files found")
+    for (provider, account), shards in load_shards(files).items():
+        merged = merge_account(provider, account, shards)
+        if merged is None:
+            continue
+        services, pruned_regions = merged
+        file_path = f"{provider}-{account}-units.csv" if account else f"{provider}-units.csv"
+        with open(file_path, 'w') as f:
+            f.writelines(csv_lines(provider, services, pruned_regions))
+        print("[Info] Results stored at", file_path)
+
+
+if __name__ == '__main__':
+    main()
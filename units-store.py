@@ -0,0 +1,142 @@
+import argparse
+import os
+import sqlite3
+from itertools import groupby
+
+from units_common import csv_lines, exact_workloads, latest_run, stored_pruned_regions
+
+# Usage python3 ./units-store.py --db units.db runs
+#       python3 ./units-store.py --db units.db aggregate --run <run_id> --by provider account
+#       python3 ./units-store.py --db units.db diff <run_id_1> <run_id_2>
+#       python3 ./units-store.py --db units.db export --run <run_id> --provider aws --accounts <profile_1>
+# Results get into the store by running the *-units.py scripts with --db units.db
+
+GROUP_COLUMNS = ("provider", "account", "scope", "service")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="SentinelOne CNS Unit Store")
+    parser.add_argument("--db", help="SQLite file written by the scripts' --db option", default="units.db", required=False)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("runs", help="List the stored runs")
+
+    aggregate_parser = commands.add_parser("aggregate", help="Sum the units and workloads of a run")
+    aggregate_parser.add_argument("--run", help="Run to aggregate (default: latest)", default=None, required=False)
+    aggregate_parser.add_argument("--by", help="Columns to group by", nargs='+', choices=GROUP_COLUMNS, default=["provider"], required=False)
+
+    diff_parser = commands.add_parser("diff", help="Compare the units of two runs per account and service")
+    diff_parser.add_argument("runs", help="The older and the newer run", nargs=2)
+
+    export_parser = commands.add_parser("export", help="Write a run back to {provider}-{account}-units.csv files")
+    export_parser.add_argument("--run", help="Run to export (default: latest)", default=None, required=False)
+    export_parser.add_argument("--provider", help="Only export this provider", default=None, required=False)
+    export_parser.add_argument("--accounts", help="Only export these account(s) separated by space", nargs='+', default=[], required=False)
+    return parser.parse_args(argv)
+
+
+def list_runs(db):
+    # workloads are summed from the integer counts per multiplier, not from the stored float workloads
+    workloads = {}
+    for run, workload_multiplier, count in db.execute(
+            "SELECT run, workload_multiplier, SUM(count) FROM results GROUP BY run, workload_multiplier"):
+        workloads[run] = workloads.get(run, 0) + exact_workloads(count, workload_multiplier)
+
+    print("Run, Accounts, Unit Counted, Workloads, Errors")
+    for run, accounts, count, errors in db.execute(
+            "SELECT run, COUNT(DISTINCT provider || '|' || account), SUM(count), SUM(error != '') "
+            "FROM results GROUP BY run ORDER BY MIN(timestamp)"):
+        print(f"{run}, {accounts}, {count}, {round(workloads[run])}, {errors}")
+
+
+def aggregate(db, run, by):
+    columns = ", ".join(by)
+    print(f"{', '.join(c.capitalize() for c in by)}, Unit Counted, Workloads, Errors")
+    total_count = 0
+    total_workloads = 0
+    rows = db.execute(
+        f"SELECT {columns}, workload_multiplier, SUM(count), SUM(error != '') FROM results "
+        f"WHERE run = ? GROUP BY {columns}, workload_multiplier ORDER BY {columns}", (run,))
+    for keys, key_rows in groupby(rows, key=lambda row: row[:len(by)]):
+        count = 0
+        workloads = 0
+        errors = 0
+        for *_, workload_multiplier, multiplier_count, multiplier_errors in key_rows:
+            count += multiplier_count
+            workloads += exact_workloads(multiplier_count, workload_multiplier)
+            errors += multiplier_errors
+        total_count += count
+        total_workloads += workloads
+        print(f"{', '.join(keys)}, {count}, {workloads}, {errors}")
+    print(f"TOTAL, {', ' * (len(by) - 1)}{total_count}, {round(total_workloads)}, ")
+
+
+def run_counts(db, run):
+    return {
+        (provider, account, service): (count, errors)
+        for provider, account, service, count, errors in db.execute(
+            "SELECT provider, account, service, SUM(count), SUM(error != '') FROM results "
+            "WHERE run = ? GROUP BY provider, account, service", (run,))
+    }
+
+
+def diff(db, old_run, new_run):
+    old = run_counts(db, old_run)
+    new = run_counts(db, new_run)
+    print(f"Provider, Account, Resource Type, {old_run}, {new_run}, Change")
+    for key in sorted(set(old) | set(new)):
+        old_count, old_errors = old.get(key, (0, 0))
+        new_count, new_errors = new.get(key, (0, 0))
+        if old_count == new_count:
+            continue
+        # a count from a run with errors for that service is only a lower bound
+        note = " (errors)" if old_errors or new_errors else ""
+        print(f"{', '.join(key)}, {old_count}, {new_count}, {new_count - old_count:+}{note}")
+
+
+def export(db, run, provider, accounts):
+    query = "SELECT DISTINCT provider, account FROM results WHERE run = ?"
+    params = [run]
+    if provider:
+        query += " AND provider = ?"
+        params.append(provider)
+    for provider, account in db.execute(query, params).fetchall():
+        if accounts and account not in accounts:
+            continue
+
+        # rows were inserted in the scripts' service and region order
+        services = {}
+        for service, count, workload_multiplier, error in db.execute(
+                "SELECT service, count, workload_multiplier, error FROM results "
+                "WHERE run = ? AND provider = ? AND account = ? ORDER BY rowid", (run, provider, account)):
+            if service not in services:
+                services[service] = [service, 0, workload_multiplier, '']
+            services[service][1] += count
+            services[service][3] += error
+
+        file_path = f"{provider}-{account}-units.csv" if account else f"{provider}-units.csv"
+        with open(file_path, 'w') as f:
+            f.writelines(csv_lines(provider, list(services.values()), stored_pruned_regions(db, run, provider, account)))
+        print("[Info] Results stored at", file_path)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.db):
+        raise Exception(f"no results store at {args.db}, run the scripts with --db {args.db} first")
+    db = sqlite3.connect(args.db)
+    try:
+        if args.command == "runs":
+            list_runs(db)
+        elif args.command == "aggregate":
+            aggregate(db, args.run or latest_run(db), args.by)
+        elif args.command == "diff":
+            diff(db, *args.runs)
+        elif args.command == "export":
+            export(db, args.run or latest_run(db), args.provider, args.accounts)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
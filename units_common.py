@@ -0,0 +1,822 @@
+import argparse
+import datetime
+import hashlib
+import heapq
+import importlib
+import json
+import os
+import queue
+import signal
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from itertools import groupby
+
+# Shared helpers for the *-units.py scripts. Keep this file next to the scripts.
+
+HISTORY_FILE = "units-history.json"
+
+DEFAULT_CALL_TIMEOUT = 300
+DEFAULT_CELL_TIMEOUT = 1800
+DEFAULT_HEDGE_FACTOR = 3
+
+# provider: (script module, audit class)
+AUDITS = {
+    "aws": ("aws-units", "SentinelOneCNSAWSUnitAudit"),
+    "azure": ("azure-units", "SentinelOneCNSAzureUnitAudit"),
+    "gcp": ("gcp-units", "SentinelOneCNSGCPUnitAudit"),
+    "oci": ("oci-units", "SentinelOneCNSOCIUnitAudit"),
+    "alibaba": ("alibaba-units", "SentinelOneCNSAlibabaUnitAudit"),
+    "digitalocean": ("digitalocean-units", "SentinelOneCNSDigitalOceanUnitAudit"),
+}
+
+# seconds assumed for a cell that has never been timed
+DEFAULT_CELL_SECONDS = 5.0
+
+# provider: (csv header, label of the total row, whether services that found nothing get a row)
+CSV_LAYOUTS = {
+    "aws": ("Resource Type, Unit Counted, Workloads, Error Regions", "TOTAL", False),
+    "alibaba": ("Resource Type, Unit Counted, Workloads, Error Regions", "TOTAL", False),
+    "oci": ("Resource Type, Unit Counted, Workloads, Error Compartments", "TOTAL", True),
+    "azure": ("Resource Type, Unit Counted, Workloads", "Total Resource", False),
+    "gcp": ("Resource Type, Unit Counted, Workloads, Error Locations", "TOTAL", False),
+    "digitalocean": ("Resource Type, Unit Counted, Workloads", "TOTAL", False),
+}
+
+# weight of the newest sample when smoothing a cell's duration
+HISTORY_SMOOTHING = 0.5
+
+# a call is only hedged once its api has this many timed calls and has run for at least HEDGE_MIN_SECONDS
+HEDGE_MIN_SAMPLES = 5
+HEDGE_MIN_SECONDS = 2.0
+LATENCY_SAMPLES = 50
+
+
+class CellHistory:
+    # Durations of past (provider, account, service, region) cells, used to start the slowest cells first
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self.durations = self.load()
+        self.recorded = {}
+        self.lock = threading.Lock()
+        # running [sum, count] of the durations per (provider, service) and overall, for cells without history
+        self.service_sums = {}
+        self.overall_sum = [0.0, 0]
+        for key, seconds in self.durations.items():
+            self.add_to_sums(key, seconds, 1)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("[Error] ignoring unreadable history file", self.path, e)
+            return {}
+
+    @staticmethod
+    def key(provider, account, service, scope=''):
+        return "|".join([provider, account or '', service, scope or ''])
+
+    @staticmethod
+    def service_of(key):
+        provider, _, service, _ = key.split("|", 3)
+        return provider, service
+
+    def add_to_sums(self, key, seconds, n):
+        sums = self.service_sums.setdefault(self.service_of(key), [0.0, 0])
+        for total in (sums, self.overall_sum):
+            total[0] += n * seconds
+            total[1] += n
+
+    def estimate(self, key):
+        if key in self.durations:
+            return self.durations[key]
+
+        # no history for this cell: fall back to the same service in other regions/accounts, then to everything
+        for total, count in (self.service_sums.get(self.service_of(key), (0, 0)), self.overall_sum):
+            if count:
+                return total / count
+        return DEFAULT_CELL_SECONDS
+
+    def record(self, key, seconds):
+        with self.lock:
+            previous = self.durations.get(key)
+            if previous is None:
+                self.durations[key] = seconds
+            else:
+                self.durations[key] = HISTORY_SMOOTHING * seconds + (1 - HISTORY_SMOOTHING) * previous
+                self.add_to_sums(key, previous, -1)
+            self.add_to_sums(key, self.durations[key], 1)
+            self.recorded[key] = self.durations[key]
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            # other audits may share the file (eg. under multicloud-units.py), only overwrite our own cells
+            durations = self.load()
+            durations.update(self.recorded)
+            try:
+                write_json(self.path, durations)
+            except OSError as e:
+                print("[Error] could not write history file", self.path, e)
+
+
+def temp_file(path):
+    # a temp file next to path, unique across the processes and threads writing it, to os.replace path with
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    return os.fdopen(fd, 'w'), temp_path
+
+
+def write_json(path, data):
+    f, temp_path = temp_file(path)
+    try:
+        with f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class _Attempt(threading.Thread):
+    # One run of a command in its own process group, so a timeout can kill the whole tree
+    def __init__(self, command, stderr, done):
+        super().__init__(daemon=True)
+        self.done = done
+        self.output = None
+        self.started = time.monotonic()
+        self.proc = subprocess.Popen(
+            command, universal_newlines=True, shell=True, stdout=subprocess.PIPE, stderr=stderr,
+            start_new_session=True
+        )
+        self.start()
+
+    def run(self):
+        self.output, _ = self.proc.communicate()
+        self.done.put(self)
+
+    def kill(self):
+        if self.proc.poll() is not None:
+            return
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
+            pass
+
+
+class CellsCancelled(Exception):
+    # raised by the calls of cells still running after run_cells gave up on them (eg. on Ctrl-C)
+    pass
+
+
+class CommandRunner:
+    # Runs cli commands with a per-call and per-cell deadline, and hedges calls that are much slower than usual.
+    # Timeouts raise subprocess.TimeoutExpired, failures raise subprocess.CalledProcessError like check_output.
+    def __init__(self, call_timeout=DEFAULT_CALL_TIMEOUT, cell_timeout=DEFAULT_CELL_TIMEOUT, hedge_factor=DEFAULT_HEDGE_FACTOR):
+        self.call_timeout = call_timeout or None
+        self.cell_timeout = cell_timeout or None
+        self.hedge_factor = hedge_factor
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # running attempts and the cancel event of the cell they belong to
+        self.live = {}
+
+    def start_cell(self, cancelled=None):
+        self.local.cell_deadline = time.monotonic() + self.cell_timeout if self.cell_timeout else None
+        self.local.cancelled = cancelled
+
+    def end_cell(self):
+        self.local.cell_deadline = None
+        self.local.cancelled = None
+
+    def cancel(self, cancelled):
+        # kills the calls of the cells started with this event, their next calls raise CellsCancelled
+        with self.lock:
+            cancelled.set()
+            attempts = [attempt for attempt, event in self.live.items() if event is cancelled]
+        for attempt in attempts:
+            attempt.kill()
+
+    def start_attempt(self, command, stderr, done):
+        cancelled = getattr(self.local, 'cancelled', None)
+        if cancelled is not None and cancelled.is_set():
+            raise CellsCancelled(command)
+        attempt = _Attempt(command, stderr, done)
+        with self.lock:
+            self.live[attempt] = cancelled
+        if cancelled is not None and cancelled.is_set():
+            # cancel() ran while the process was starting
+            attempt.kill()
+        return attempt
+
+    def hedge_after(self, api):
+        if not api or not self.hedge_factor:
+            return None
+        with self.lock:
+            samples = sorted(self.latencies.get(api, []))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_SECONDS, self.hedge_factor * samples[len(samples) // 2])
+
+    def record(self, api, seconds):
+        if not api:
+            return
+        with self.lock:
+            samples = self.latencies.setdefault(api, [])
+            samples.append(seconds)
+            del samples[:-LATENCY_SAMPLES]
+
+    def check_output(self, command, api=None, stderr=None):
+        # api names the kind of call (eg. "ec2 describe-instances"), latencies are compared per api
+        started = time.monotonic()
+        deadline = started + self.call_timeout if self.call_timeout else None
+        cell_deadline = getattr(self.local, 'cell_deadline', None)
+        if cell_deadline is not None and (deadline is None or cell_deadline < deadline):
+            deadline = cell_deadline
+        hedge_after = self.hedge_after(api)
+
+        done = queue.Queue()
+        attempts = [self.start_attempt(command, stderr, done)]
+        failed = []
+        try:
+            while True:
+                now = time.monotonic()
+                wait = None
+                if deadline is not None:
+                    wait = deadline - now
+                if hedge_after is not None and len(attempts) == 1:
+                    hedge_wait = started + hedge_after - now
+                    wait = hedge_wait if wait is None else min(wait, hedge_wait)
+                try:
+                    attempt = done.get(timeout=max(wait, 0) if wait is not None else None)
+                except queue.Empty:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise subprocess.TimeoutExpired(command, deadline - started)
+                    print("[Info] hedging slow call", api)
+                    attempts.append(self.start_attempt(command, stderr, done))
+                    continue
+                if attempt.proc.returncode == 0:
+                    break
+                # a hedge failing fast (eg. throttled) must not cut short an attempt that may still succeed
+                failed.append(attempt)
+                if len(failed) == len(attempts):
+                    cancelled = getattr(self.local, 'cancelled', None)
+                    if cancelled is not None and cancelled.is_set():
+                        raise CellsCancelled(command)
+                    raise subprocess.CalledProcessError(attempt.proc.returncode, command, output=attempt.output)
+        finally:
+            with self.lock:
+                for running in attempts:
+                    self.live.pop(running, None)
+            for running in attempts:
+                running.kill()
+
+        self.record(api, time.monotonic() - attempt.started)
+        return attempt.output
+
+
+def run_cells(cells, workers=1, history=None, runner=None):
+    # cells is a list of (history_key, fn). Returns (fn() result, seconds taken) in the same order as cells.
+    # With more than one worker the historically slowest cells are submitted first, so the
+    # short ones fill in idle workers at the end instead of a long cell starting last.
+    results = [None] * len(cells)
+
+    cancelled = threading.Event()
+
+    def run(index):
+        key, fn = cells[index]
+        started = time.monotonic()
+        if runner is not None:
+            runner.start_cell(cancelled)
+        try:
+            result = fn()
+        finally:
+            if runner is not None:
+                runner.end_cell()
+        seconds = time.monotonic() - started
+        results[index] = (result, seconds)
+        if history is not None:
+            history.record(key, seconds)
+
+    if workers <= 1:
+        for index in range(len(cells)):
+            run(index)
+    else:
+        order = list(range(len(cells)))
+        if history is not None:
+            order.sort(key=lambda i: history.estimate(cells[i][0]), reverse=True)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for future in [executor.submit(run, index) for index in order]:
+                future.result()
+        except BaseException:
+            # eg. Ctrl-C, which does not reach the cli processes in their own sessions: drop the queued cells
+            # and kill the running calls instead of waiting for all cells to finish
+            executor.shutdown(wait=False, cancel_futures=True)
+            if runner is not None:
+                runner.cancel(cancelled)
+            raise
+        executor.shutdown()
+
+    if history is not None:
+        history.save()
+    return results
+
+
+def add_run_args(parser, scope="region", workers=1, cells=True, shard=True):
+    # The options shared by the scripts. scope is what the services are listed per, None when each service is one cell
+    cell = f"(service, {scope}) cell" if scope else "service"
+    if cells:
+        parser.add_argument("--workers", help=f"Number of {cell}s to fetch in parallel", type=int, default=workers, required=False)
+        parser.add_argument("--history-file", help="File keeping past cell durations, slowest cells are started first", default=HISTORY_FILE, required=False)
+    parser.add_argument("--call-timeout", help="Seconds before a single cli call is killed (0 for no limit)", type=float, default=DEFAULT_CALL_TIMEOUT, required=False)
+    if cells:
+        parser.add_argument("--cell-timeout", help=f"Seconds before a {cell} is given up (0 for no limit)", type=float, default=DEFAULT_CELL_TIMEOUT, required=False)
+    parser.add_argument("--hedge-factor", help="Start a duplicate call when one takes this many times the usual latency of its api (0 to disable)", type=float, default=DEFAULT_HEDGE_FACTOR, required=False)
+    parser.add_argument("--db", help="SQLite file to also store the per region/service results in", default=None, required=False)
+    parser.add_argument("--run-id", help="Name of this run in the --db store (default: start time)", default=None, required=False)
+    if shard:
+        parser.add_argument("--shard", help="Only run shard i of N (eg. 2/4) and write a shard file for units-merge.py", type=parse_shard, default=None, required=False)
+
+
+def load_audit(provider):
+    # The scripts' file names are not valid module names, eg. load_audit("aws")("default").count_all()
+    # The runner, history and store given to an audit can be shared by many audits in one process
+    module, audit = AUDITS[provider]
+    return getattr(importlib.import_module(module), audit)
+
+
+class AuditResult:
+    # What count_all() returns, instead of reading the csv back
+    def __init__(self, provider, account):
+        self.provider = provider
+        self.account = account
+        # (svcName, count, workload_multiplier, error) in the order of count_all
+        self.services = []
+        # (svcName, region/compartment or '', count, error, seconds) of every cell that ran
+        self.cells = []
+        self.pruned_regions = None
+        self.seconds = 0
+
+    @property
+    def total_resource_count(self):
+        return sum(count for _, count, _, _ in self.services)
+
+    @property
+    def total_workload_count(self):
+        return sum(exact_workloads(count, workload_multiplier) for _, count, workload_multiplier, _ in self.services)
+
+    @property
+    def errors(self):
+        return [(svcName, scope, error) for svcName, scope, _, error, _ in self.cells if error]
+
+    def csv_lines(self):
+        return csv_lines(self.provider, self.services, self.pruned_regions)
+
+
+def exact_workloads(count, workload_multiplier):
+    # multipliers like 0.1 are not exact as floats (6 * 0.1 == 0.6000000000000001), apply them as decimals
+    return count * Decimal(str(workload_multiplier))
+
+
+def csv_lines(provider, services, pruned_regions=None):
+    # Lines of the {provider}-{account}-units.csv file, as written by the provider's script.
+    # services is a list of (svcName, count, workload_multiplier, error) in the order of count_all,
+    # pruned_regions the regions skipped by --prune-regions (None when it was not used).
+    header, total_label, write_empty = CSV_LAYOUTS[provider]
+    error_column = header.count(",") == 3
+    total_resource_count = 0
+    total_workload_count = 0
+    lines = [header + "\n"]
+
+    for svcName, count, workload_multiplier, error in services:
+        if error and not error_column:
+            # providers without an error column put the error in place of the count
+            lines.append(f"{svcName}, {error}, \n")
+            continue
+        if not (count or error or write_empty):
+            continue
+        workloads = exact_workloads(count, workload_multiplier)
+        total_resource_count += count
+        total_workload_count += workloads
+        if error_column:
+            lines.append(f"{svcName}, {count}, {workloads}, {error}\n")
+        else:
+            lines.append(f"{svcName}, {count}, {workloads}\n")
+
+    total = f"{total_label}, {total_resource_count}, {round(total_workload_count)}"
+    lines.append(total + (", \n" if error_column else "\n"))
+    if pruned_regions is not None:
+        lines.append(pruned_regions_line(pruned_regions))
+    return lines
+
+
+def prune_regions(regions, used_regions, found="usage"):
+    # used_regions is what the pre-pass found in use, None when it failed. Returns the regions to count and the
+    # pruned ones (None when not pruning).
+    if used_regions is None:
+        return regions, None
+    if not used_regions:
+        # more likely a pre-pass that sees nothing (eg. Cost Explorer just enabled) than an empty account
+        print(f"[Error] found no region with {found}, not pruning regions")
+        return regions, None
+    kept = [region for region in regions if region in used_regions]
+    pruned = [region for region in regions if region not in used_regions]
+    print(f"[Info] Regions with {found}", kept)
+    print(f"[Info] Pruned regions without {found}", pruned)
+    return kept, pruned
+
+
+def pruned_regions_line(pruned_regions):
+    # the unit columns are left empty, so summing them over the rows does not count regions as units
+    return "Pruned Regions, , , {regions}\n".format(regions="".join(f"{r}, " for r in pruned_regions))
+
+
+def default_run_id():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class ResultStore:
+    # Per (region/compartment, service) counts of every run, kept in a local sqlite file.
+    # Rows are buffered by add() and written in one transaction by commit().
+    def __init__(self, path, run_id=None):
+        self.path = path
+        self.run_id = run_id or default_run_id()
+        self.pending = []
+        self.pending_pruned = []
+        self.lock = threading.Lock()
+
+        db = self.connect()
+        try:
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS results ("
+                    "run TEXT, provider TEXT, account TEXT, scope TEXT, service TEXT, "
+                    "count INTEGER, workload_multiplier NUMERIC, workloads REAL, error TEXT, timestamp TEXT)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS results_run ON results (run, provider, account)")
+                # one row per cell and run, so a rerun shard replaces its rows instead of adding them again.
+                # Stores written before this index keep their latest row of each cell.
+                if db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'results_cell'").fetchone() is None:
+                    db.execute(
+                        "DELETE FROM results WHERE rowid NOT IN "
+                        "(SELECT MAX(rowid) FROM results GROUP BY run, provider, account, scope, service)"
+                    )
+                    db.execute("CREATE UNIQUE INDEX results_cell ON results (run, provider, account, scope, service)")
+                db.execute("CREATE INDEX IF NOT EXISTS results_account ON results (provider, account, service)")
+                db.execute("CREATE INDEX IF NOT EXISTS results_service ON results (service, scope)")
+                # regions skipped by --prune-regions, as a json list, so the Pruned Regions row can be exported
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS pruned_regions ("
+                    "run TEXT, provider TEXT, account TEXT, regions TEXT, PRIMARY KEY (run, provider, account))"
+                )
+        finally:
+            db.close()
+
+    def connect(self):
+        # several audits may write at the same time (eg. under multicloud-units.py), wait for their locks
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add(self, provider, account, scope, service, count, workload_multiplier, error=''):
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        with self.lock:
+            self.pending.append((
+                self.run_id, provider, account or '', scope or '', service,
+                # workloads is only informative, sums use the integer counts and workload_multiplier
+                count, workload_multiplier, float(exact_workloads(count, workload_multiplier)), error or '', timestamp
+            ))
+
+    def add_pruned_regions(self, provider, account, regions):
+        with self.lock:
+            self.pending_pruned.append((self.run_id, provider, account or '', json.dumps(regions)))
+
+    def commit(self):
+        with self.lock:
+            rows, self.pending = self.pending, []
+            pruned, self.pending_pruned = self.pending_pruned, []
+        if not rows and not pruned:
+            return
+        db = self.connect()
+        try:
+            with db:
+                # the replaced row keeps its rowid, so export still lists the cells in the scripts' order
+                db.executemany(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (run, provider, account, scope, service) DO UPDATE SET "
+                    "count = excluded.count, workload_multiplier = excluded.workload_multiplier, "
+                    "workloads = excluded.workloads, error = excluded.error, timestamp = excluded.timestamp",
+                    rows
+                )
+                # every shard of an account stores the same pruned regions
+                db.executemany("INSERT OR REPLACE INTO pruned_regions VALUES (?, ?, ?, ?)", pruned)
+        finally:
+            db.close()
+
+
+def store_from_args(args):
+    # the ResultStore of the --db and --run-id options, None without --db
+    if not args.db:
+        return None
+    # shards run on other machines at other times, only a given run id adds them up to one run
+    if getattr(args, "shard", None) and not args.run_id:
+        raise Exception("--db with --shard needs a --run-id, the same on every shard")
+    return ResultStore(args.db, args.run_id or default_run_id())
+
+
+def latest_run(db):
+    # the run most recently added to a ResultStore file
+    row = db.execute("SELECT run FROM results ORDER BY timestamp DESC, rowid DESC LIMIT 1").fetchone()
+    if row is None:
+        raise Exception("no results stored in the db yet")
+    return row[0]
+
+
+def stored_pruned_regions(db, run, provider, account):
+    # the regions pruned from an account in a run of a ResultStore file, None when --prune-regions was not used
+    if db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'pruned_regions'").fetchone() is None:
+        return None
+    row = db.execute(
+        "SELECT regions FROM pruned_regions WHERE run = ? AND provider = ? AND account = ?", (run, provider, account or '')
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def parse_shard(value):
+    # "--shard 2/4" is the second of four shards
+    try:
+        index, total = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, got {value}")
+    if not 1 <= index <= total:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {total}, got {index}")
+    return index, total
+
+
+def shard_of(key, total):
+    # sha1 rather than hash(), which changes between python processes
+    return int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) % total + 1
+
+
+def in_shard(key, shard):
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+def shard_file_path(provider, account, shard):
+    prefix = f"{provider}-{account}-units" if account else f"{provider}-units"
+    return f"{prefix}.shard-{shard[0]}-of-{shard[1]}.json"
+
+
+def write_shard(provider, account, shard, services, scopes, results, pruned_regions=None):
+    # services is a list of (svcName, workload_multiplier) and scopes the regions/compartments, both in the
+    # order of a single node run. scopes is a {svcName: scopes} dict when the services have different scopes.
+    # results has the (count, error) of the cells of this shard by (svcName, scope).
+    file_path = shard_file_path(provider, account, shard)
+    with open(file_path, 'w') as f:
+        json.dump({
+            "provider": provider,
+            "account": account,
+            "shard": list(shard),
+            "services": [list(service) for service in services],
+            "scopes": scopes if isinstance(scopes, dict) else list(scopes),
+            "cells": [[svcName, scope, count, error] for (svcName, scope), (count, error) in results.items()],
+            "pruned_regions": pruned_regions,
+        }, f, indent=1)
+    return file_path
+
+
+# count of a matrix cell that was not counted (eg. it belongs to another shard)
+MISSING = -1
+
+MATRIX_FILE = "units-matrix.jsonl"
+
+
+class CountMatrix:
+    # The services of a matrix file, with their workload multipliers. The counts themselves are kept per account
+    # in AccountCounts, so a matrix file can be read, merged and rolled up one account at a time.
+    def __init__(self):
+        self.services = []
+        self.multipliers = []
+        self.service_index = {}
+
+    def service(self, provider, svcName, workload_multiplier=1):
+        key = (provider, svcName)
+        if key not in self.service_index:
+            self.service_index[key] = len(self.services)
+            self.services.append(key)
+            self.multipliers.append(Decimal(str(workload_multiplier)))
+        return self.service_index[key]
+
+    def header(self):
+        return {"services": [[provider, svcName, str(m)] for (provider, svcName), m in zip(self.services, self.multipliers)]}
+
+    @classmethod
+    def from_header(cls, header):
+        matrix = cls()
+        for provider, svcName, workload_multiplier in header["services"]:
+            matrix.service(provider, svcName, workload_multiplier)
+        return matrix
+
+    def account_from_cells(self, provider, account, cells, pruned_regions=None):
+        # cells are (svcName, scope, count, workload_multiplier, error), a later cell replaces an earlier one
+        cells = [(self.service(provider, svcName, workload_multiplier), scope or '', count, error)
+                 for svcName, scope, count, workload_multiplier, error in cells]
+        counts = AccountCounts(provider, account, unique(c[0] for c in cells), unique(c[1] for c in cells))
+        counts.pruned_regions = pruned_regions
+        for service, scope, count, error in cells:
+            counts.set(service, scope, count, error)
+        return counts
+
+    def account_from_result(self, result):
+        multipliers = {svcName: workload_multiplier for svcName, _, workload_multiplier, _ in result.services}
+        return self.account_from_cells(result.provider, result.account, [
+            (svcName, scope, count, multipliers[svcName], error) for svcName, scope, count, error, _ in result.cells
+        ], result.pruned_regions)
+
+
+class AccountCounts:
+    # Unit counts of one account as a (services x regions/compartments) integer array, MISSING where not counted.
+    # services are indexes into the CountMatrix services, scopes the account's regions/compartments ('' if none).
+    def __init__(self, provider, account, services, scopes):
+        self.provider = provider
+        self.account = account or ''
+        self.services = list(services)
+        self.scopes = list(scopes)
+        self.service_pos = {service: i for i, service in enumerate(self.services)}
+        self.scope_pos = {scope: j for j, scope in enumerate(self.scopes)}
+        self.counts = array('q', [MISSING]) * (len(self.services) * len(self.scopes))
+        self.errors = {}
+        # regions skipped by --prune-regions, None when it was not used
+        self.pruned_regions = None
+
+    @property
+    def key(self):
+        return (self.provider, self.account)
+
+    def set(self, service, scope, count, error=''):
+        i = self.service_pos[service] * len(self.scopes) + self.scope_pos[scope]
+        self.counts[i] = count
+        if error:
+            self.errors[i] = error
+        else:
+            self.errors.pop(i, None)
+
+    def cells(self):
+        # (service, scope, count, error) of the counted cells
+        width = len(self.scopes)
+        for i, count in enumerate(self.counts):
+            if count != MISSING:
+                yield self.services[i // width], self.scopes[i % width], count, self.errors.get(i, '')
+
+    @classmethod
+    def merged(cls, records):
+        # records of the same account in the order they were written, later counts replace earlier ones
+        counts = cls(records[0].provider, records[0].account,
+                     unique(s for r in records for s in r.services), unique(s for r in records for s in r.scopes))
+        for record in records:
+            for service, scope, count, error in record.cells():
+                counts.set(service, scope, count, error)
+            if record.pruned_regions is not None:
+                counts.pruned_regions = record.pruned_regions
+        return counts
+
+    def line(self):
+        return json.dumps({
+            "provider": self.provider,
+            "account": self.account,
+            "services": self.services,
+            "scopes": self.scopes,
+            "counts": self.counts.tolist(),
+            "errors": sorted([i, error] for i, error in self.errors.items()),
+            "pruned_regions": self.pruned_regions,
+        }) + "\n"
+
+    @classmethod
+    def from_line(cls, line, service_map=None):
+        # service_map translates the services of the file the line was read from into another matrix's services
+        j = json.loads(line)
+        services = j["services"] if service_map is None else [service_map[s] for s in j["services"]]
+        counts = cls(j["provider"], j["account"], services, j["scopes"])
+        counts.counts = array('q', j["counts"])
+        counts.errors = {i: error for i, error in j["errors"]}
+        counts.pruned_regions = j.get("pruned_regions")
+        return counts
+
+
+def unique(values):
+    return list(dict.fromkeys(values))
+
+
+def write_matrix(path, matrix, accounts):
+    # accounts must come in (provider, account) order, so the file can be merged with others one account at a time
+    f, temp_path = temp_file(path)
+    previous = None
+    try:
+        with f:
+            f.write(json.dumps(matrix.header()) + "\n")
+            for counts in accounts:
+                if previous is not None and counts.key <= previous:
+                    raise Exception(f"matrix accounts out of order: {counts.key} after {previous}")
+                previous = counts.key
+                f.write(counts.line())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return path
+
+
+def write_results_matrix(path, results):
+    # a matrix file of the AuditResults of count_all(), eg. of audits run from python
+    matrix = CountMatrix()
+    accounts = sorted((matrix.account_from_result(result) for result in results), key=lambda counts: counts.key)
+    return write_matrix(path, matrix, accounts)
+
+
+def read_matrix(path, matrix=None):
+    # returns the file's CountMatrix and an iterator over its AccountCounts. With a matrix, the file's services
+    # are added to that matrix and the counts refer to its services instead.
+    f = open(path)
+    file_matrix = CountMatrix.from_header(json.loads(f.readline()))
+    service_map = None
+    if matrix is not None:
+        service_map = [matrix.service(provider, svcName, m)
+                       for (provider, svcName), m in zip(file_matrix.services, file_matrix.multipliers)]
+
+    def accounts():
+        with f:
+            for line in f:
+                yield AccountCounts.from_line(line, service_map)
+
+    return matrix or file_matrix, accounts()
+
+
+def merge_matrices(paths, out_path):
+    # Streams the accounts of all files in (provider, account) order, so only one account is held at a time.
+    # Where files count the same cell (eg. two runs), the file given last wins.
+    matrix = CountMatrix()
+    streams = [read_matrix(path, matrix)[1] for path in paths]
+    merged = (
+        AccountCounts.merged(list(records))
+        for _, records in groupby(heapq.merge(*streams, key=lambda counts: counts.key), key=lambda counts: counts.key)
+    )
+    return write_matrix(out_path, matrix, merged)
+
+
+ROLLUP_LEVELS = ("provider", "account", "region", "service")
+
+
+def rollup(matrix, accounts, levels=ROLLUP_LEVELS):
+    # One pass over the accounts for all levels. Every key sums its counts per matrix service, workloads are only
+    # computed from those integer sums at the end. Returns {level: [(key, units, workloads, errors)]}.
+    n = len(matrix.services)
+    totals = {level: {} for level in levels}
+
+    def add(level, key, service, count, errors):
+        if level not in totals:
+            return
+        if key not in totals[level]:
+            totals[level][key] = [array('q', [0]) * n, 0]
+        total = totals[level][key]
+        total[0][service] += count
+        total[1] += errors
+
+    for counts in accounts:
+        width = len(counts.scopes)
+        errors = array('b', [0]) * len(counts.counts)
+        for i in counts.errors:
+            errors[i] = 1
+        for row, service in enumerate(counts.services):
+            provider, svcName = matrix.services[service]
+            start = row * width
+            cells = counts.counts[start:start + width]
+            cell_errors = errors[start:start + width]
+            row_count = sum(count for count in cells if count != MISSING)
+            row_errors = sum(cell_errors)
+            add("provider", (provider,), service, row_count, row_errors)
+            add("account", (provider, counts.account), service, row_count, row_errors)
+            add("service", (provider, svcName), service, row_count, row_errors)
+            if "region" in totals:
+                for scope, count, error in zip(counts.scopes, cells, cell_errors):
+                    if count != MISSING:
+                        add("region", (provider, scope), service, count, error)
+
+    return {
+        level: [
+            (key, sum(services), sum(c * m for c, m in zip(services, matrix.multipliers) if c), errors)
+            for key, (services, errors) in sorted(totals[level].items())
+        ]
+        for level in levels
+    }